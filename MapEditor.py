@@ -2,29 +2,117 @@
 #   MAP EDITOR
 #========================================
 
-print('[INFO] Starting map editor...')
-
-from tkinter import *
-from tkinter import ttk
+try:
+    from tkinter import *
+    from tkinter import ttk
+    from tkinter import filedialog
+    import _tkinter
+except ImportError:
+    pass #the map classes are usable without Tk, e.g. by the benchmarks
+from mapcore import *
 import pygame
 from pygame.locals import *
 from pygame.math import Vector2
 import threading
+import queue
 import time
 import math
+import random
 import os
+import io
+import json
+import base64
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 FPS_LIMIT = 144
 WINDOW_WIDTH = 800
 WINDOW_HEIGHT = 600
-BACKGROUND = (10,10,10)
 
-PREVENT_OVERLAP = False
+PREVENT_OVERLAP = False #drop a placement whose opaque pixels would overlap one of the same sprite
+BRUSH_RADIUS = 24
+PAINT_SPACING = 16 #pixels between stamps while painting with S, also the dedupe cell size
+PAINT_JITTER = 0 #max random offset of each stamp in pixels
+PAINT_DENSITY = 1.0 #chance each stamp is kept
+RENDER_MODE = 'dirty' #'dirty' redraws only what changed, 'full' redraws the whole window every frame
+IDLE_FPS = 20
+TK_BUDGET = 8 #ms of Tk event handling per frame
+JOB_BUDGET = 8 #ms per frame for jobs that edit the open map
+ASSET_ROOT = 'assets'
+ASSET_LAYERS = {'icons': None, 'tiles': 'tiles'} #layer of the images in each top folder of ASSET_ROOT, 'objects' if not listed, 'tiles' for the ground tile grid. None hides the folder
+IMAGE_TYPES = ('.png', '.bmp', '.jpg', '.jpeg', '.gif', '.tga')
+CATALOG_CACHE = os.path.join(ASSET_ROOT, '.catalog.json')
+ATLAS_CACHE = os.path.join(ASSET_ROOT, '.atlas') #folder keeping the packed sprite atlas between runs
+AUTOSAVE_DIR = 'autosave' #the open map is kept here and reopened at the next start, None turns autosave off
+CATALOG_WORKERS = 4
+THUMB_SIZE = 16
+PROFILE_KEY = K_F3 #shows the frame time overlay
+TRACE_KEY = K_F4 #starts recording a Chrome trace, pressed again writes it to TRACE_PATH
+TRACE_PATH = 'trace-%Y%m%d-%H%M%S.json'
+
+class Animation:
+    '''A named list of frames shared by every sprite that plays it, delay is seconds per frame'''
+    __slots__ = ('name', 'costumes', 'delay', 'loop', 'frames')
+
+    def __init__(self, name, costumes, delay=None, loop=True):
+        self.name = name
+        self.costumes = costumes
+        self.delay = delay
+        self.loop = loop
+        self.frames = len(costumes)
+
+    def costume(self, elapsed):
+        '''The frame showing elapsed seconds into the animation'''
+        if not self.delay or self.frames < 2:
+            return self.costumes[0]
+        frame = int(elapsed/self.delay)
+        if self.loop:
+            return self.costumes[frame % self.frames]
+        return self.costumes[min(frame, self.frames-1)]
+
+class AnimationRegistry:
+    '''Frame lists and animations shared across sprites, and the clock that plays them.
+    time advances by the delta passed to tick once per frame, sprites read their frame
+    from it when drawn so off screen ones cost nothing. Only standalone Sprite objects
+    animate: placements on a Map are drawn from their SpriteType's single image'''
+    def __init__(self):
+        self.frame_lists = {}
+        self.animations = {}
+        self.time = 0.0
+
+    def tick(self, ms):
+        self.time += ms/1000
+        return ms
+
+    def frames(self, paths, scale2x=False, recolor=None):
+        '''Frames for the image files in paths, loaded once. recolor is an optional
+        (old colour, new colour) pair applied to copies of the shared surfaces'''
+        key = (tuple(os.path.normpath(path) for path in paths), scale2x, recolor)
+        if key not in self.frame_lists:
+            frames = [ASSETS.load(path, scale2x=scale2x) for path in paths]
+            if recolor:
+                frames = [frame.copy() for frame in frames]
+                for frame in frames:
+                    with pygame.PixelArray(frame) as pixels:
+                        pixels.replace(*recolor)
+            self.frame_lists[key] = frames
+        return self.frame_lists[key]
+
+    def get(self, name, costumes, delay=None, loop=True):
+        '''The shared animation of the surfaces in costumes'''
+        key = (name, tuple(costumes), delay, loop)
+        animation = self.animations.get(key)
+        if animation is None:
+            animation = self.animations[key] = Animation(name, list(costumes), delay, loop)
+        return animation
+
+ANIMATIONS = AnimationRegistry()
 
 class GameObject:
     def load_image(self, filename):
-        self.image = pygame.image.load(filename).convert_alpha()
+        self.image = ASSETS.load(filename)
         self.width = self.image.get_width()
         self.height = self.image.get_height()
         self.centre = (self.width/2, self.height/2)
@@ -33,10 +121,19 @@ class GameObject:
         self.image = imag
         self.width = self.image.get_width()
         self.height = self.image.get_height()
+
+    @property
+    def mask(self):
+        '''Collision mask of the current image, shared with every sprite showing it'''
+        return MASKS.get(self.image)
         
     def rect(self):
         """ Generates a rectangle representing the objects location and dimensions """
-        return pygame.Rect(self.game.display_surface.blit(self.image, (self.x-self.width/2, self.y-self.height/2)))
+        return pygame.Rect(self.x-self.width/2, self.y-self.height/2, self.width, self.height)
+
+    def map_rect(self):
+        """ Same rectangle in map coordinates, independent of the camera """
+        return pygame.Rect(self.mapx-self.width/2, self.mapy-self.height/2, self.width, self.height)
                            
     def draw(self):
         """ draw the game object at the current x, y coordinates """
@@ -50,7 +147,7 @@ class Image:
         self.mapx = 0
         self.mapy = 0
         self.z = False
-        self.image = pygame.image.load(loc).convert_alpha()
+        self.image = ASSETS.load(loc)
         self.width = self.image.get_width()
         self.height = self.image.get_height()
         
@@ -60,7 +157,10 @@ class Image:
         return self
     
     def rect(self):    
-        return pygame.Rect(self.x-self.width/2, self.y-self.height, self.width, self.height)
+        return pygame.Rect(self.x-self.width/2, self.y-self.height/2, self.width, self.height)
+
+    def map_rect(self):
+        return pygame.Rect(self.mapx-self.width/2, self.mapy-self.height/2, self.width, self.height)
     
     def update(self):
         self.game.display_surface.blit(self.image, (self.x-self.width/2, self.y-self.height/2))
@@ -79,9 +179,9 @@ class Sprite(GameObject):
         self.brightness = 0 
         self.groups = []
         self.hitbox = (self.x, self.y, 0, 0)
-        self.animations = []
-        self.animation = {}
-        self.frame = 0
+        self.animations = {}
+        self.animation = None
+        self.started = 0
         self.playing = False
 
     def new(self, loc):
@@ -127,40 +227,32 @@ class Sprite(GameObject):
     #Collision       
     def collide_rect(self, other):
         '''Check if the sprite's rect collides with the other sprite's rect'''
-        if self.rect().colliderect(other.rect()):
-            return True
-        else:
-            return False
+        return bool(self.rect().colliderect(other.rect()))
         
     def collide_mask(self, other):
-        '''Check if the sprite's mask collides with the other sprite's mask. Returns point of collision, else None'''
-        offset_x = self.x - other.x
-        offset_y = self.y - other.y
-        return self.mask.overlap(other.mask, (offset_x, offset_y))
+        '''Check if the sprite's mask collides with the other sprite's mask. Returns point of collision relative to this sprite's image, else None'''
+        rect, other_rect = self.rect(), other.rect()
+        if not rect.colliderect(other_rect):
+            return None
+        return self.mask.overlap(other.mask, (other_rect.x-rect.x, other_rect.y-rect.y))
 
     def collide_hitbox(self, other):
-        pygame.Rect(self.hitbox[0], self.hitbox[1], self.hitbox[2], self.hitbox[3]).colliderect(pygame.Rect(other.hitbox[0], other.hitbox[1], other.hitbox[2], other.hitbox[3]))
+        return bool(pygame.Rect(self.hitbox).colliderect(pygame.Rect(other.hitbox)))
 
     #Animation    
     def add_animation(self, name, costumes=[], delay=None, loop=True):
         '''Add a new animation to the sprite'''
-        loaded = []
-        for loc in costumes:
-            img = pygame.image.load(loc).convert_alpha()
-            loaded += [pygame.transform.scale2x(img)] #covert alpha
-        self.animations += [{'name': name, 'costumes':loaded, 'delay':delay, 'loop':loop, 'frames':len(costumes)}]
+        self.animations[name] = ANIMATIONS.get(name, ANIMATIONS.frames(costumes, scale2x=True), delay, loop)
 
     def add_animation_surface(self, name, surfaces=[], delay=None, loop=True):
-        self.animations += [{'name': name, 'costumes':surfaces, 'delay':delay, 'loop':loop, 'frames':len(surfaces)}]
+        self.animations[name] = ANIMATIONS.get(name, surfaces, delay, loop)
         
-    def play(self, animation_name):
-        '''Play an animation'''
-        for anim in self.animations:
-            if anim['name'] == animation_name:
-                self.animation = anim
-                break
-        self.frame = 0
-        self.set_image(self.animation['costumes'][int(self.frame)])
+    def play(self, animation_name, desync=False):
+        '''Play an animation. Looping animations stay in step with every other sprite
+        playing them unless desync is set, others start from their first frame'''
+        self.animation = self.animations[animation_name]
+        self.started = ANIMATIONS.time if desync or not self.animation.loop else 0
+        self.set_image(self.animation.costume(ANIMATIONS.time-self.started))
         self.playing = True
 
     def stop(self):
@@ -168,87 +260,114 @@ class Sprite(GameObject):
         self.playing = False
 
     def update(self):
-        '''Update the object'''
-        self.z_index = self.mapy + self.height
+        '''Update the object, sprites off screen are skipped'''
+        if self.hide or not self.rect().colliderect(self.game.display_surface.get_rect()):
+            return
         if self.playing:
-            if self.animation['delay']!= None:
-                self.frame += 1/(FPS_LIMIT*self.animation['delay'])
-                if (self.frame >= self.animation['frames']) and self.animation['loop']:
-                    if self.animation['loop']:
-                        self.frame = 0
-                    else:
-                        self.frame = self.animation['frames']-1
-                        return 0
-                self.set_image(self.animation['costumes'][int(self.frame)])
+            image = self.animation.costume(ANIMATIONS.time-self.started)
+            if image is not self.image:
+                self.set_image(image)
         self.draw()
 
 class Area:
+    '''A rect, circle or polygon ('poly') around centre. Polygons are compared by their bounding rect'''
     def __init__(self, shape='rect', centre=(), radius=0, height=0, width=0, points=[]):
         self.shape = shape
-        self.centre = centre
+        self.centre = centre or (0, 0)
         self.radius = radius
+        self.height = height
+        self.width = width
         self.points = points
+
+    def rect(self, offset=(0, 0)):
+        x, y = self.centre[0]+offset[0], self.centre[1]+offset[1]
+        if self.shape == 'circle':
+            return pygame.Rect(x-self.radius, y-self.radius, self.radius*2, self.radius*2)
+        if self.shape == 'poly' and self.points:
+            xs, ys = [p[0] for p in self.points], [p[1] for p in self.points]
+            return pygame.Rect(x+min(xs), y+min(ys), max(xs)-min(xs), max(ys)-min(ys))
+        return pygame.Rect(x-self.width/2, y-self.height/2, self.width, self.height)
     
-    def overlaps(self, other, offset):
-        pass
-
-class Map:
-    def __init__(self, game, size=(800,600)):
-        self.game = game
-        self.name = 'untitled'
-        self.size = size
-        self.camx = 0
-        self.camy = 0
-        self.color = (50, 130, 0)
-        self.objects = []
-        self.images_fg = []
-        self.images_bg = []
-        
-    def draw_base(self):
-        pygame.draw.rect(self.game.display_surface, self.color, (self.camx, self.camy, self.size[0], self.size[1]))
-    
-    def design(self, obj=[]):
-        self.objects += obj
-        for i in obj:
-            i.game = self.game
-
-    def decorate(self, obj=[]):
-        for i in obj:
-            if i.z:
-                self.images_fg += [i]
-            else:
-                self.images_bg += [i]
-            i.game = self.game
-            
-    def update(self):
-        self.draw_base()
-        for img in self.images_bg:
-            img.x = img.mapx + self.camx
-            img.y = img.mapy + self.camy
-            img.update()
-            
-        objs = sorted(self.objects, key = lambda i: i.z_index)
-        for obj in objs:
-            obj.x = obj.mapx + self.camx
-            obj.y = obj.mapy + self.camy
-            obj.update()
-
-        for img in self.images_fg:
-            img.x = img.mapx + self.camx
-            img.y = img.mapy + self.camy
-            img.update()
-        
+    def overlaps(self, other, offset=(0, 0)):
+        '''Whether this area overlaps other moved by offset'''
+        if self.shape == 'circle' and other.shape == 'circle':
+            dx = other.centre[0]+offset[0]-self.centre[0]
+            dy = other.centre[1]+offset[1]-self.centre[1]
+            return dx*dx + dy*dy < (self.radius+other.radius)**2
+        if self.shape == 'circle' or other.shape == 'circle':
+            circle, box = (self, other.rect(offset)) if self.shape == 'circle' else (other, self.rect())
+            x, y = circle.centre if circle is self else (circle.centre[0]+offset[0], circle.centre[1]+offset[1])
+            dx = max(box.left-x, 0, x-box.right)
+            dy = max(box.top-y, 0, y-box.bottom)
+            return dx*dx + dy*dy < circle.radius**2
+        return bool(self.rect().colliderect(other.rect(offset)))
+
+def blocked(m, type_id, x, y):
+    '''With PREVENT_OVERLAP, whether a placement of type_id at (x, y) would overlap the opaque pixels of one of the same type'''
+    return PREVENT_OVERLAP and any(m.type_ids[row] == type_id for row in m.overlapping(type_id, x, y))
+
+class Stroke:
+    '''A continuous paint stroke of one sprite type. Stamps are laid every spacing
+    pixels along the cursor path, whatever the frame rate, and at most one goes in
+    each spacing sized cell. With PREVENT_OVERLAP a stamp is also dropped when it
+    would overlap a placement of the same type'''
+    def __init__(self, m, type_id, spacing=PAINT_SPACING, jitter=PAINT_JITTER, density=PAINT_DENSITY, seed=None):
+        self.map = m
+        self.type_id = type_id
+        self.spacing = max(1, spacing)
+        self.jitter = jitter
+        self.density = density
+        self.random = random.Random(seed)
+        self.cells = set()
+        self.last = None
+        self.carry = 0.0
+
+    def to(self, x, y):
+        '''Extend the stroke to the map point (x, y), returns the rows placed'''
+        if self.last is None:
+            points = [(x, y)]
+        else:
+            lx, ly = self.last
+            dist = math.hypot(x-lx, y-ly)
+            points = []
+            step = self.spacing - self.carry
+            while step <= dist:
+                points += [(lx+(x-lx)*step/dist, ly+(y-ly)*step/dist)]
+                step += self.spacing
+            self.carry = dist - (step - self.spacing)
+        self.last = (x, y)
+        return [row for row in (self.stamp(px, py) for px, py in points) if row is not None]
+
+    def stamp(self, x, y):
+        if self.density < 1 and self.random.random() >= self.density:
+            return None
+        if self.jitter:
+            x += self.random.uniform(-self.jitter, self.jitter)
+            y += self.random.uniform(-self.jitter, self.jitter)
+        x, y = int(round(x)), int(round(y))
+        cell = (x//self.spacing, y//self.spacing)
+        if cell in self.cells:
+            return None
+        self.cells.add(cell)
+        if self.taken(x, y, cell):
+            return None
+        return self.map.add(self.type_id, x, y)
+
+    def taken(self, x, y, cell):
+        '''Whether a placement of the same type already claims the stamp at (x, y)'''
+        m = self.map
+        t = m.types[self.type_id]
+        if PREVENT_OVERLAP:
+            return blocked(m, self.type_id, x, y)
+        area = pygame.Rect(cell[0]*self.spacing, cell[1]*self.spacing, self.spacing, self.spacing)
+        return any(m.type_ids[row] == self.type_id and area.collidepoint(m.xs[row], m.ys[row]) for row in m.query_rect(area, (t.layer,)))
+
 class Player(Sprite):
     def __init__(self, color=(255,153,153), speed=5):
         super().__init__()
-        walk1 = pygame.image.load(r'assets\player\walk1.png').convert_alpha()
-        walk2 = pygame.image.load(r'assets\player\walk2.png').convert_alpha()
-        walk1_array = pygame.PixelArray(walk1)
-        walk2_array = pygame.PixelArray(walk2)
-        walk1_array.replace((255,255,255), color)
-        walk2_array.replace((255,255,255), color)
-        self.add_animation_surface('idle',[walk1])
-        self.add_animation_surface('walk',[walk1, walk2], delay = 0.2)        
+        walk = ANIMATIONS.frames(['assets/player/walk1.png', 'assets/player/walk2.png'], recolor=((255,255,255), tuple(color)))
+        self.add_animation_surface('idle', walk[:1])
+        self.add_animation_surface('walk', walk, delay = 0.2)        
         self.play('idle')
         self.SPEED = speed*(1/FPS_LIMIT)
         self.color = color
@@ -258,30 +377,179 @@ class New1(Sprite):
         super().__init__()
         self.load_image(loc)
         self.name = name
+        self.path = loc
 
 class New2(Image):
     def __init__(self, loc, name, z=False):
         super().__init__(loc)
         self.name = name
+        self.path = loc
         self.z = bool(z)
+
+class Tile(Image):
+    '''A ground tile, painted into the map's tile grid instead of placed'''
+    def __init__(self, loc, name):
+        super().__init__(loc)
+        self.name = name
+        self.path = loc
+        self.image = tile_surface(loc)
+        self.width = self.image.get_width()
+        self.height = self.image.get_height()
         
+class Scheduler:
+    '''Splits the UI thread between the renderer and Tk and keeps slow work off it.
+    submit runs a function on a worker thread, spawn runs a generator that edits the
+    open map a slice at a time between frames. Workers post progress and results on
+    a queue that poll drains, so done callbacks always run on the UI thread'''
+    def __init__(self, tk_budget=TK_BUDGET, job_budget=JOB_BUDGET):
+        self.tk_budget = tk_budget
+        self.job_budget = job_budget
+        self.queue = queue.Queue()
+        self.jobs = deque()
+        self.progress = {}
+
+    def submit(self, name, work, done=None):
+        '''Run work(progress) on a worker thread, then done(result) on the UI thread.
+        progress takes a short text shown while the job runs'''
+        if name in self.progress:
+            print('[INFO]', name, 'is already running')
+            return False
+        self.progress[name] = ''
+        def run():
+            try:
+                result = work(lambda text: self.queue.put((name, 'progress', text, None)))
+            except Exception as e:
+                self.queue.put((name, 'error', e, None))
+            else:
+                self.queue.put((name, 'done', result, done))
+        threading.Thread(target=run, name=name, daemon=True).start()
+        return True
+
+    def call(self, fn, value):
+        '''Have fn(value) run on the UI thread at the next poll, from any thread'''
+        self.queue.put((None, 'call', value, fn))
+
+    def spawn(self, name, steps, done=None):
+        '''Advance the generator steps for up to job_budget ms each frame, each value it
+        yields is its progress. done() is called once it is exhausted'''
+        self.progress[name] = ''
+        self.jobs.append((name, steps, done))
+
+    def poll(self):
+        '''Handle what the workers posted since the last frame'''
+        while True:
+            try:
+                name, kind, value, done = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if kind == 'call':
+                done(value)
+                continue
+            if kind == 'progress':
+                self.progress[name] = value
+                continue
+            del self.progress[name]
+            if kind == 'error':
+                print('[ERROR]', name, 'failed:', repr(value))
+            elif done:
+                done(value)
+
+    def step(self):
+        '''Run spawned jobs until the frame's job budget is spent'''
+        end = time.perf_counter() + self.job_budget/1000
+        while self.jobs and time.perf_counter() < end:
+            name, steps, done = self.jobs[0]
+            try:
+                self.progress[name] = next(steps)
+            except StopIteration:
+                self.jobs.popleft()
+                del self.progress[name]
+                if done:
+                    done()
+
+    def pump(self, root):
+        '''Handle pending Tk events for up to tk_budget ms. Raises TclError once the
+        Tk window is gone'''
+        end = time.perf_counter() + self.tk_budget/1000
+        while root.tk.dooneevent(_tkinter.DONT_WAIT) and time.perf_counter() < end:
+            pass
+        root.winfo_exists()
+
+    def status(self):
+        return '  '.join('{} {}'.format(name, text).strip() for name, text in self.progress.items())
+
+JOBS = Scheduler()
+
+def video_driver():
+    '''SDL video driver able to draw into the Tk frame on this platform, None if SDL
+    should pick its own'''
+    if sys.platform == 'win32':
+        return 'windows' if pygame.version.vernum[0] >= 2 else 'windib'
+    if sys.platform.startswith('linux') or 'bsd' in sys.platform:
+        return 'x11' if os.environ.get('DISPLAY') else 'dummy'
+    return None
+
 class Editor:
     def __init__(self):
         global SPRITES
         pygame.init()
         pygame.display.set_caption('Map Editor')
         self.display_surface = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT), pygame.RESIZABLE)#, pygame.HWSURFACE| pygame.DOUBLEBUF)
+        CATALOG.pack(ATLAS_CACHE)
         self.clock = pygame.time.Clock()
         self.blocks = []
         self.font = pygame.font.SysFont("Arial", 18)
         self.running = True
         icon = pygame.image.load('assets/icons/icon128.png')
         pygame.display.set_icon(icon)
+        self.autosave = None
+        self.drag = None
+        self.selection = []
+        self.selection_rect = None
+        self.selection_map = None
+        self.hint = None
+        self.hint_base = None
+        self.hint_level = 0
+        self.hint_offset = (0, 0)
+        self.fps_text = None
+        self.fps_time = 0
+        self.redraw = True
+        self.shown = ()
+        self.shown_map = None
+        self.shown_cam = None
+        self.stroke = None
+        self.panel = None
+        self.panel_rect = None
+        self.panel_time = 0
         
     def update_fps(self):
+        '''The FPS text, re-rendered a few times a second. Returns None if unchanged'''
+        now = time.perf_counter()
+        if self.fps_text is not None and now - self.fps_time < 0.25:
+            return None
+        self.fps_time = now
         fps = str(int(self.clock.get_fps()))
-        fps_text = self.font.render(fps, 1, pygame.Color("white"))
-        return fps_text
+        if JOBS.progress:
+            fps += '  ' + JOBS.status()
+        self.fps_text = self.font.render(fps, 1, pygame.Color("white"))
+        return self.fps_text
+
+    def bake_hint(self):
+        '''Build the translucent placement preview once per selection'''
+        start = PROFILE.start()
+        sprite = csprite()
+        self.hint_base = sprite.image.copy()
+        self.hint_base.fill((255, 255, 255, 128), None, pygame.BLEND_RGBA_MULT)
+        self.scale_hint(self.hint_level)
+        self.redraw = True
+        self.stroke = None
+        PROFILE.stop('bake', start)
+
+    def scale_hint(self, level):
+        '''Size the placement preview for the zoom level'''
+        self.hint = MIPS.get(self.hint_base, level)
+        self.hint_offset = (int(self.hint_base.get_width()//2*2.0**level), int(self.hint_base.get_height()//2*2.0**level))
+        self.hint_level = level
 
     def UpdatePlayers(self, data):
         for i in data:
@@ -291,10 +559,157 @@ class Editor:
                 if i != self.id:
                     self.Others[i] = OtherPlayer(self)
         
+    def map_rect(self, start, end):
+        '''Map rect under the screen rectangle between two corners'''
+        left, top = cmap.to_map(min(start[0], end[0]), min(start[1], end[1]))
+        right, bottom = cmap.to_map(max(start[0], end[0]), max(start[1], end[1]))
+        return pygame.Rect(left, top, right-left, bottom-top)
+
+    def select_rect(self, start, end):
+        '''Select everything overlapping the screen rectangle between two corners'''
+        rect = self.map_rect(start, end)
+        self.selection = cmap.query_rect(rect)
+        self.selection_rect = rect
+        self.selection_map = cmap
+
+    def deselect(self):
+        self.selection = []
+        self.selection_rect = None
+        self.selection_map = None
+
+    def tile(self):
+        '''Tile id of the selected sprite in the open map, None if it is not a tile'''
+        sprite = csprite()
+        if not isinstance(sprite, Tile):
+            print('[INFO] Pick a tile from', ASSET_ROOT+'/tiles', 'to fill with')
+            return None
+        return cmap.tile_type(sprite)
+
+    def place(self, pos):
+        '''Paint the selected sprite at the screen point, tiles into the cell under it'''
+        sprite = csprite()
+        x, y = cmap.to_map(*pos)
+        if isinstance(sprite, Tile):
+            cmap.set_tile(x, y, cmap.tile_type(sprite))
+        elif blocked(cmap, cmap.type_of(sprite), x, y):
+            return
+        elif '1' in str(type(sprite)):
+            cmap.design([sprite.at(x, y)])
+        else:
+            cmap.decorate([sprite.at(x, y)])
+
+    def draw_tool(self, pos):
+        '''Outline the brush, the rectangle being dragged or the current selection'''
+        if TOOL == 'Brush':
+            pygame.draw.circle(self.display_surface, pygame.Color('white'), pos, BRUSH_RADIUS, 1)
+        elif TOOL in ('Select', 'Rect'):
+            if self.drag:
+                rect = pygame.Rect(min(self.drag[0], pos[0]), min(self.drag[1], pos[1]), abs(pos[0]-self.drag[0]), abs(pos[1]-self.drag[1]))
+                pygame.draw.rect(self.display_surface, pygame.Color('white'), rect, 1)
+            elif TOOL == 'Select' and self.selection_rect:
+                pygame.draw.rect(self.display_surface, pygame.Color('yellow'), cmap.screen_rect(self.selection_rect), 1)
+
+    def overlays(self, pos):
+        '''Screen rects covered by the placement hint and the tool outline at pos'''
+        rects = []
+        if not(ERASE):
+            rects += [self.hint.get_rect(topleft=(pos[0]-self.hint_offset[0], pos[1]-self.hint_offset[1]))]
+        if TOOL == 'Brush':
+            rects += [pygame.Rect(pos[0]-BRUSH_RADIUS-1, pos[1]-BRUSH_RADIUS-1, BRUSH_RADIUS*2+3, BRUSH_RADIUS*2+3)]
+        elif TOOL in ('Select', 'Rect'):
+            if self.drag:
+                rects += [pygame.Rect(min(self.drag[0], pos[0]), min(self.drag[1], pos[1]), abs(pos[0]-self.drag[0])+1, abs(pos[1]-self.drag[1])+1)]
+            elif TOOL == 'Select' and self.selection_rect:
+                rects += [cmap.screen_rect(self.selection_rect).inflate(1, 1)]
+        return tuple(rects)
+
+    def draw_overlays(self, pos):
+        start = PROFILE.start()
+        if not(ERASE):
+            self.display_surface.blit(self.hint, (pos[0]-self.hint_offset[0], pos[1]-self.hint_offset[1]))
+        PROFILE.stop('hint', start)
+        self.draw_tool(pos)
+        self.display_surface.blit(self.fps_text, (10,0))
+        if self.panel:
+            self.display_surface.blit(self.panel, self.panel_rect)
+
+    def profile_panel(self):
+        '''The profiler overlay: frame time percentiles over a graph of the recent frames
+        (the line is the FPS_LIMIT budget), then last frame's sections and counters'''
+        white = pygame.Color('white')
+        lines = ['frame p50 {:.2f}  p95 {:.2f}  p99 {:.2f} ms'.format(*[PROFILE.percentile(p) for p in (50, 95, 99)])]
+        lines += ['{} {:.3f} ms'.format(name, ms) for name, ms in sorted(PROFILE.last_times.items())]
+        lines += ['{} {}'.format(name, n) for name, n in sorted(PROFILE.last_counts.items())]
+        if PROFILE.events is not None:
+            lines += ['recording trace, {} events'.format(len(PROFILE.events))]
+        texts = [self.font.render(line, 1, white) for line in lines]
+        graph = 60
+        width = max([PROFILE.frames.maxlen] + [text.get_width() for text in texts]) + 8
+        panel = pygame.Surface((width, graph + sum(text.get_height() for text in texts) + 8), pygame.SRCALPHA)
+        panel.fill((0, 0, 0, 170))
+        budget = 1000/FPS_LIMIT
+        top = max([budget*2] + list(PROFILE.frames))
+        for x, ms in enumerate(PROFILE.frames):
+            height = max(1, int(ms/top*graph))
+            panel.fill((255, 80, 80) if ms > budget else (80, 220, 80), (4+x, 4+graph-height, 1, height))
+        y = 4+graph-int(budget/top*graph)
+        pygame.draw.line(panel, white, (4, y), (4+PROFILE.frames.maxlen, y))
+        y = 4+graph+2
+        for text in texts:
+            panel.blit(text, (4, y))
+            y += text.get_height()
+        return panel
+
+    def damage(self, pos):
+        '''Screen rects to redraw this frame: whatever moved or changed since the
+        last one, or the whole window in full mode, after a pan or a new map'''
+        screen = self.display_surface.get_rect()
+        if self.selection_map not in (None, cmap): #rows only mean something in the map they were selected in
+            self.deselect()
+        if self.hint_level != cmap.level:
+            self.scale_hint(cmap.level)
+        old = self.fps_text.get_rect(topleft=(10, 0)) if self.fps_text else None
+        text = self.update_fps()
+        rects = [old, text.get_rect(topleft=(10, 0))] if text else []
+        now = time.perf_counter()
+        if PROFILE.enabled and (self.panel is None or now - self.panel_time >= 0.1):
+            rects += [self.panel_rect]
+            self.panel = self.profile_panel()
+            self.panel_rect = self.panel.get_rect(topright=(screen.right-10, 10))
+            self.panel_time = now
+            rects += [self.panel_rect]
+        elif not PROFILE.enabled and self.panel:
+            rects += [self.panel_rect]
+            self.panel = None
+        shown = self.overlays(pos)
+        if shown != self.shown:
+            rects += self.shown + shown
+        self.shown = shown
+        full = self.redraw or RENDER_MODE == 'full' or cmap is not self.shown_map or (cmap.camx, cmap.camy, cmap.level) != self.shown_cam
+        if cmap.damaged is not None:
+            rects += [cmap.screen_rect(rect) for rect in cmap.damaged]
+        cmap.damaged = []
+        self.shown_map = cmap
+        self.shown_cam = (cmap.camx, cmap.camy, cmap.level)
+        self.redraw = False
+        if full:
+            return [screen]
+        rects = [rect.clip(screen) for rect in rects if rect and rect.colliderect(screen)]
+        if len(rects) > 16:
+            return [rects[0].unionall(rects)]
+        return rects
+
     def start(self):
         global csprite, cmap
-        undo = []
-        cmap = Map(self)
+        self.bake_hint()
+        cmap = None
+        if AUTOSAVE_DIR:
+            try:
+                cmap = recover(AUTOSAVE_DIR, self)
+            except Exception as e:
+                print('[ERROR] Could not recover the autosave:', repr(e))
+        if cmap is None:
+            cmap = Map(self)
         lastpos = (pygame.mouse.get_pos())    
         while self.running:
             if pygame.mouse.get_pressed()[1]:
@@ -304,105 +719,326 @@ class Editor:
                 lastpos = pygame.mouse.get_pos()
         
             lastpos = (pygame.mouse.get_pos())
-            for event in pygame.event.get():
+            if cmap.journal is None:
+                cmap.journal = Journal()
+            if AUTOSAVE_DIR and cmap.autosave is None:
+                if self.autosave:
+                    self.autosave.close()
+                self.autosave = Autosave(cmap, AUTOSAVE_DIR)
+            start = PROFILE.start()
+            events = pygame.event.get()
+            for event in events:
                 if event.type == QUIT:
                     self.running = False
+
+                if event.type in (VIDEORESIZE, VIDEOEXPOSE):
+                    self.redraw = True
             
                 if event.type == KEYDOWN:
                     if event.key == K_ESCAPE:
                         self.running = False
+                    if event.key == PROFILE_KEY:
+                        PROFILE.toggle()
+                    if event.key == TRACE_KEY:
+                        if PROFILE.events is None:
+                            PROFILE.record()
+                        else:
+                            path = time.strftime(TRACE_PATH)
+                            print('[INFO] Wrote', PROFILE.dump(path), 'trace events to', path)
                     if event.key == K_1:
                         var.set("Paint")
                         selected_t("Paint")
                     if event.key == K_2:
                         var.set("Erase")
                         selected_t("Erase")
-                    if event.key == K_z:
-                        try:
-                            undo += [cmap.objects.pop()]
-                        except:
-                            pass
+                    if event.key == K_3:
+                        var.set("Brush")
+                        selected_t("Brush")
+                    if event.key == K_4:
+                        var.set("Select")
+                        selected_t("Select")
+                    if event.key == K_5:
+                        var.set("Fill")
+                        selected_t("Fill")
+                    if event.key == K_6:
+                        var.set("Rect")
+                        selected_t("Rect")
+                    if event.key in (K_DELETE, K_BACKSPACE) and self.selection and self.selection_map is cmap:
+                        JOBS.spawn('erase', cmap.erase_slices(self.selection))
+                        self.deselect()
+                    if event.key == K_z and event.mod & KMOD_SHIFT or event.key == K_y:
+                        cmap.journal.redo(cmap)
+                    elif event.key == K_z:
+                        cmap.journal.undo(cmap)
+                    if event.key == K_s:
+                        cmap.journal.begin()
                     if event.key == K_a:            
-                        if '1' in str(type(csprite())):
-                            cmap.design([csprite().at(lastpos[0]-cmap.camx, lastpos[1]-cmap.camy)])
-                        else:
-                            cmap.decorate([csprite().at(lastpos[0]-cmap.camx, lastpos[1]-cmap.camy)])
+                        self.place(lastpos)
+
+                if event.type == KEYUP and event.key == K_s:
+                    cmap.journal.end()
+                    self.stroke = None
 
                 if event.type == MOUSEBUTTONDOWN:
+                    if event.button in (4, 5): #the wheel, zooming around the pointer
+                        cmap.zoom_to(cmap.level + (1 if event.button == 4 else -1), *event.pos)
                     if event.button == 1:
+                        cmap.journal.begin()
                         if not(ERASE):
-                            if '1' in str(type(csprite())):
-                                cmap.design([csprite().at(event.pos[0]-cmap.camx, event.pos[1]-cmap.camy)])
-                            else:
-                                cmap.decorate([csprite().at(event.pos[0]-cmap.camx, event.pos[1]-cmap.camy)])
-                        else:                            
-                            for i in cmap.objects: 
-                                if i.rect().collidepoint(event.pos[0], event.pos[1]):
-                                    cmap.objects.remove(i)                                    
-                                    break
-                            for i in cmap.images_fg:
-                                if i.rect().collidepoint(event.pos[0], event.pos[1]):
-                                    cmap.images_fg.remove(i)                                    
-                                    break
-                            for i in cmap.images_bg:
-                                if i.rect().collidepoint(event.pos[0], event.pos[1]):
-                                    cmap.images_bg.remove(i)                                    
-                                    break                                                                        
+                            self.place(event.pos)
+                        elif TOOL in ('Select', 'Rect'):
+                            self.drag = event.pos
+                        elif TOOL == 'Fill':
+                            tile = self.tile()
+                            if tile is not None:
+                                cmap.flood_tiles(*cmap.to_map(*event.pos), tile)
+                        elif TOOL == 'Erase':
+                            hits = [cmap.hit(layer, event.pos[0], event.pos[1]) for layer in ('objects', 'fg', 'bg')]
+                            for i in hits:
+                                if i is not None:
+                                    cmap.erase(i)
+                            if hits.count(None) == len(hits): #nothing placed there, clear the ground tile
+                                cmap.set_tile(*cmap.to_map(*event.pos), 0)
+
+                if event.type == MOUSEBUTTONUP:
+                    if event.button == 1:
+                        cmap.journal.end()
+                    if event.button == 1 and self.drag:
+                        if TOOL == 'Rect':
+                            tile = self.tile()
+                            if tile is not None:
+                                cmap.fill_tiles(self.map_rect(self.drag, event.pos), tile)
+                        else:
+                            self.select_rect(self.drag, event.pos)
+                        self.drag = None
+
+            if TOOL == 'Brush' and pygame.mouse.get_pressed()[0]:
+                cmap.erase_many(cmap.query_radius(*cmap.to_map(*lastpos), BRUSH_RADIUS/cmap.zoom))
 
             key = pygame.key.get_pressed()
-            if key[K_s]:
-                if PREVENT_OVERLAP and cmap.objects and lastpos[0] != cmap.objects[-1].x and lastpos[1] != cmap.objects[-1].y:
-                    if '1' in str(type(csprite())):
-                        cmap.design([csprite().at(lastpos[0]-cmap.camx, lastpos[1]-cmap.camy)])
-                    else:
-                        cmap.decorate([csprite().at(lastpos[0]-cmap.camx, lastpos[1]-cmap.camy)])
-                else:
-                    if '1' in str(type(csprite())):
-                        cmap.design([csprite().at(lastpos[0]-cmap.camx, lastpos[1]-cmap.camy)])
-                    else:
-                        cmap.decorate([csprite().at(lastpos[0]-cmap.camx, lastpos[1]-cmap.camy)])
-            
-            if key[K_LCTRL] and key[K_z]:
-                try:
-                    undo += [cmap.objects.pop()]
-                except:
-                    pass
+            if key[K_s] and isinstance(csprite(), Tile):
+                cmap.set_tile(*cmap.to_map(*lastpos), cmap.tile_type(csprite()))
+            elif key[K_s]:
+                if self.stroke is None or self.stroke.map is not cmap:
+                    self.stroke = Stroke(cmap, cmap.type_of(csprite()))
+                self.stroke.to(*cmap.to_map(*lastpos))
+            start = PROFILE.stop('events', start)
             
-            self.display_surface.fill(BACKGROUND)
-            cmap.update()
-            hint = csprite().image.copy()
-            hint.fill((255, 255, 255, 128), None, pygame.BLEND_RGBA_MULT)
-            if not(ERASE):
-                self.display_surface.blit(hint, (lastpos[0]-csprite().width/2, lastpos[1]-csprite().height/2))        
-            self.display_surface.blit(self.update_fps(), (10,0))
-            pygame.display.update()
-            self.clock.tick(FPS_LIMIT)
+            rects = self.damage(lastpos)
+            for rect in rects:
+                self.display_surface.set_clip(rect)
+                self.display_surface.fill(BACKGROUND, rect)
+                cmap.update(rect)
+                self.draw_overlays(lastpos)
+            self.display_surface.set_clip(None)
+            start = PROFILE.start()
+            if rects:
+                pygame.display.update(rects)
+            start = PROFILE.stop('display.update', start)
+            busy = events or rects or any(pygame.mouse.get_pressed()) or key[K_s] or JOBS.jobs
+            ANIMATIONS.tick(self.clock.tick(FPS_LIMIT if busy else IDLE_FPS)) #for Sprite.update, the map's placements are static
+            start = PROFILE.stop('idle', start)
+            if self.autosave:
+                self.autosave.tick()
+            JOBS.poll()
+            JOBS.step()
+            start = PROFILE.stop('jobs', start)
             try:
-                root.update()
+                JOBS.pump(root)
             except:
                 break
+            PROFILE.stop('tk', start)
+            if PROFILE.enabled:
+                PROFILE.count('total', cmap.counts['objects'] + cmap.counts['fg'])
+                PROFILE.tally('chunk hits', cmap.background.hits)
+                PROFILE.tally('chunk misses', cmap.background.misses)
+                PROFILE.tally('asset hits', ASSETS.hits)
+                PROFILE.tally('asset misses', ASSETS.misses)
+            PROFILE.frame()
             
+        if self.autosave:
+            self.autosave.close()
         pygame.quit()
 
+class Catalog:
+    '''Sprites offered in the tree by id: the SPRITES entries, then the image files
+    under ASSET_ROOT. A folder is listed when first opened and its images are decoded
+    and thumbnailed on a thread pool. Each file's mtime, size and alpha bounds are
+    kept in CATALOG_CACHE'''
+    def __init__(self, root=ASSET_ROOT, cache=CATALOG_CACHE, workers=CATALOG_WORKERS):
+        self.root = root
+        self.cache = cache
+        self.workers = workers
+        self.pool = None
+        self.entries = {}
+        self.folders = set()
+        self.meta = None
+        self.thumbs = {}
+        self.queued = 0
+        self.dirty = False
+
+    def metadata(self):
+        '''path -> [mtime, width, height, alpha bounds x, y, w, h], read on first use'''
+        if self.meta is None:
+            try:
+                with open(self.cache) as f:
+                    self.meta = json.load(f)
+            except (OSError, ValueError):
+                self.meta = {}
+        return self.meta
+
+    def save(self):
+        try:
+            with open(self.cache, 'w') as f:
+                json.dump(self.meta, f, separators=(',', ':'))
+            self.dirty = False
+        except OSError as e:
+            print('[INFO] Could not write', self.cache, e)
+
+    def layer_of(self, path):
+        return ASSET_LAYERS.get(path[len(self.root)+1:].split('/')[0], 'objects')
+
+    def images(self):
+        '''Every sprite image under root that is placed as is, the ones worth packing
+        into the atlas. Hidden folders and tiles, which are drawn scaled, are left out'''
+        paths = []
+        for folder, dirs, files in os.walk(self.root):
+            folder = folder.replace(os.sep, '/')
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.') and (folder != self.root or ASSET_LAYERS.get(d, 'objects') not in (None, 'tiles')))
+            paths += [folder+'/'+f for f in sorted(files) if f.lower().endswith(IMAGE_TYPES) and not f.startswith('.')]
+        return paths
+
+    def pack(self, cache):
+        '''Pack the sprites into ATLAS on a worker a folder at a time, each folder's pages
+        are adopted on the UI thread as they come. Nothing is read before the window opens'''
+        def work(progress):
+            start = time.perf_counter()
+            folders = {}
+            for path in self.images():
+                folders.setdefault(os.path.dirname(path), []).append(path)
+            for folder, paths in folders.items():
+                progress(os.path.relpath(folder, self.root))
+                JOBS.call(self.packed, ATLAS.prepare(paths, os.path.join(cache, os.path.relpath(folder, self.root))))
+            return time.perf_counter()-start
+        JOBS.submit('atlas', work, lambda seconds: print('[INFO] Packed', len(ATLAS.regions), 'sprites into', len(ATLAS.pages), 'atlas pages in', round(seconds*1000), 'ms'))
+
+    def packed(self, packing):
+        '''Serve a folder's sprites from its atlas pages, the open map included'''
+        pages, regions = packing
+        ATLAS.adopt(pages, regions)
+        if cmap:
+            cmap.rebind(regions)
+
+    def factory(self, path):
+        name = os.path.splitext(os.path.basename(path))[0].lower()
+        layer = self.layer_of(path)
+        if layer == 'objects':
+            return lambda: New1(path, name)
+        if layer == 'tiles':
+            return lambda: Tile(path, name)
+        return lambda: New2(path, name, layer == 'fg')
+
+    def size_text(self, path, mtime):
+        meta = self.metadata().get(path)
+        return '{}x{}'.format(meta[1], meta[2]) if meta and meta[0] == mtime else ''
+
+    def add(self, tree, parent, iid, text, factory):
+        tree.insert(parent, 'end', iid=iid, text=text)
+        self.entries[iid] = factory
+
+    def folder(self, tree, parent, path, text):
+        '''Insert a folder that is listed once opened'''
+        tree.insert(parent, 'end', iid=path, text=text)
+        tree.insert(path, 'end', iid=path+'/...', text='...') #gives the folder its open arrow
+        self.folders.add(path)
+
+    def open(self, tree, path):
+        if path in self.folders:
+            self.folders.remove(path)
+            tree.delete(path+'/...')
+            self.fill(tree, path)
+
+    def fill(self, tree, folder):
+        try:
+            items = sorted(os.scandir(folder), key=lambda item: (not item.is_dir(), item.name.lower()))
+        except OSError as e:
+            print('[INFO] Could not list', folder, e)
+            return
+        images = []
+        for item in items:
+            path = folder + '/' + item.name
+            if item.name.startswith('.'):
+                continue
+            if item.is_dir():
+                if folder != self.root or ASSET_LAYERS.get(item.name, 'objects') is not None:
+                    self.folder(tree, folder, path, item.name)
+            elif item.name.lower().endswith(IMAGE_TYPES):
+                mtime = item.stat().st_mtime
+                tree.insert(folder, 'end', iid=path, text=os.path.splitext(item.name)[0], values=(self.size_text(path, mtime),))
+                self.entries[path] = self.factory(path)
+                images += [(path, mtime)]
+        self.preload(tree, images)
+
+    def preload(self, tree, images):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.workers)
+        for path, mtime in images:
+            self.queued += 1
+            self.pool.submit(self.decode, path, mtime).add_done_callback(lambda future: JOBS.call(self.loaded, (tree, future)))
+
+    @staticmethod
+    def decode(path, mtime):
+        '''Runs on the pool: decode a private copy of path, returns it with its metadata and a PNG thumbnail.
+        Scaling locks the surface, so the shared one in ASSETS is only filled in by loaded on the UI thread'''
+        surface = pygame.image.load(path)
+        width, height = surface.get_size()
+        bounds = surface.get_bounding_rect()
+        scale = min(1, THUMB_SIZE/max(width, height, 1))
+        thumb = scaled(surface, (max(1, round(width*scale)), max(1, round(height*scale))))
+        data = io.BytesIO()
+        pygame.image.save(thumb, data, 'thumb.png')
+        return path, surface, [mtime, width, height, bounds.x, bounds.y, bounds.width, bounds.height], base64.b64encode(data.getvalue())
+
+    def loaded(self, item):
+        tree, future = item
+        self.queued -= 1
+        try:
+            path, surface, meta, thumb = future.result()
+        except Exception as e:
+            print('[INFO] Could not preload an asset:', repr(e))
+        else:
+            ASSETS.store(path, surface)
+            if self.metadata().get(path) != meta:
+                self.meta[path] = meta
+                self.dirty = True
+            self.thumbs[path] = PhotoImage(data=thumb)
+            if tree.exists(path):
+                tree.item(path, image=self.thumbs[path], values=('{}x{}'.format(meta[1], meta[2]),))
+        if not self.queued and self.dirty:
+            self.save()
+
+CATALOG = Catalog()
+
 def build_tree():
-    i = 0
     for key in SPRITES:
         tree.insert('', index='end', iid=key, text=key)
         for sub in SPRITES[key]:
-            tree.insert(key, index='end', iid=sub, text=sub)
+            tree.insert(key, index='end', iid=key+'/'+sub, text=sub)
             for s in SPRITES[key][sub]:
-                tree.insert(sub, index='end', iid=s, text=s, value="SPRITES['"+key+"']['"+sub+"']['"+s+"']")
-                i = i + 1
+                CATALOG.add(tree, key+'/'+sub, key+'/'+sub+'/'+s, s, SPRITES[key][sub][s])
+    CATALOG.folder(tree, '', ASSET_ROOT, ASSET_ROOT)
         
 def tree_select(event):    
     global csprite
-    value = tree.item(tree.selection()[0], 'value')
-    if value:
-        csprite = eval(value[0])
+    selection = tree.selection()
+    if selection and selection[0] in CATALOG.entries:
+        csprite = CATALOG.entries[selection[0]]
+        main.bake_hint()
 
 def selected_t(value):
-    global ERASE
-    if value == 'Erase':
+    global ERASE, TOOL
+    TOOL = value
+    if value != 'Paint':
         ERASE = True
     else:
         ERASE = False
@@ -410,6 +1046,7 @@ def selected_t(value):
 def selected_b(value):
     global csprite
     csprite = IMAGES_BG[value]
+    main.bake_hint()
 
 def new_map():
     global cmap
@@ -435,112 +1072,33 @@ def create_new_map(this, en1, en2, en3):
     print('[INFO] New map created')
     this.destroy()
 
-def export_map():
-    print('[INFO] Building Map.. ')
-    start = time.time()
-    name = cmap.name
-    code = ''
-    code += name + ' = map.new({}, {}, {})\n'.format(str(cmap.size[0]), str(cmap.size[1]), '{'+str(round(cmap.color[0]/255, 4))+', '+str(round(cmap.color[1]/255, 4))+', '+str(round(cmap.color[2]/255, 4))+'}')    
-    spawn = ''
-    detail = ''
-    lines = 0
-    size = 0
-    clones = {}
-    for i in cmap.objects:
-        if clones.get(i.name):
-            if (i.mapx, i.mapy) in clones[i.name]:
-                continue
-            else:
-                clones[i.name] += [(i.mapx, i.mapy)]
-        else:
-            clones[i.name] = [(i.mapx, i.mapy)]
-    
-    for obj in clones:    
-        spawn += '{'+obj+'.new,{'
-        for pos in clones[obj]:
-            spawn += '{'+str(pos[0])+','+str(pos[1])+'},'
-        spawn += '}},\n'
-        lines += 1
-
-    clones = {}    
-    for i in cmap.images_bg+cmap.images_fg:
-        if clones.get(i.name):
-            if (i.mapx, i.mapy) in clones[i.name]:
-                continue
-            else:
-                clones[i.name] += [(i.mapx, i.mapy, i.z)]
-        else:
-            clones[i.name] = [(i.mapx, i.mapy, i.z)]
-    
-    for obj in clones:    
-        detail += '{'+obj+'.new,{'
-        for pos in clones[obj]:
-            if pos[2]:
-                detail += '{'+str(pos[0])+','+str(pos[1])+',1},'
-            else:
-                detail += '{'+str(pos[0])+','+str(pos[1])+'},'
-        detail += '}},\n'
-        lines += 1               
+def write_lua(export, m, path, progress=None):
+    with open(path, 'w', newline='') as f:
+        export(out=f, m=m, progress=progress)
+    return path
 
-    if cmap.objects: code += name+':spawn({\n'+spawn+'})\n'
-    if cmap.images_bg + cmap.images_bg: code += name+':detail({\n'+detail+'})'
-    
-    size = len(code)
-    print('[INFO] Map built successfully!')
-    print('[STATS] Name        : ', name)
-    print('[STATS] Lines       : ', lines)
-    print('[STATS] Size        : ', size)
-    print('[STATS] Build time  : ', round(time.time()-start, 4),'\n')
-    print(code)
-    return(code)
-
-def build_map(remove_clones=False):
-    print('[INFO] Building Map.. ')
-    start = time.time()
-    name = cmap.name
-    code = ''
-    code += name + ' = map.new()\n'
-    code += name + ':set({}, {}, {})'.format(str(cmap.size[0]), str(cmap.size[1]), '{'+str(cmap.color[0]/255)+', '+str(cmap.color[1]/255)+', '+str(cmap.color[2]/255)+'}') + '\n'
-    design = ''
-    decorate = ''
-    lines = 0
-    size = 0
-    clones = {}
-    for i in cmap.objects:
-        if clones.get(i.name):
-            if (i.mapx, i.mapy) in clones[i.name]:
-                continue
-            else:
-                clones[i.name] += [(i.mapx, i.mapy)]
-        else:
-            clones[i.name] = [(i.mapx, i.mapy)]
-        design += i.name+'.new():at('+str(i.mapx)+', '+str(i.mapy)+'),\n'
-        lines += 1
-        
-    for i in cmap.images_bg:
-        if clones.get(i.name):
-            if (i.mapx, i.mapy) in clones[i.name]:
-                continue
-            else:
-                clones[i.name] += [(i.mapx, i.mapy)]
-        else:
-            clones[i.name] = [(i.mapx, i.mapy)]
-        decorate += i.name+'.new():at('+str(i.mapx)+', '+str(i.mapy)+', '+str(bool(i.z)).lower()+'),\n'
-        lines += 1
+def save_lua(export):
+    '''Ask for a file and stream an export of the open map into it on a worker thread'''
+    path = filedialog.asksaveasfilename(initialfile=cmap.name+'.lua', defaultextension='.lua', filetypes=[('Lua', '*.lua')])
+    if path:
+        snapshot = cmap.snapshot()
+        JOBS.submit(export.__name__, lambda progress: write_lua(export, snapshot, path, progress), lambda path: print('[INFO] Saved', path))
+
+def save_dialog():
+    path = filedialog.asksaveasfilename(initialfile=cmap.name+'.umap', defaultextension='.umap', filetypes=[('Map', '*.umap')])
+    if path:
+        snapshot = cmap.snapshot()
+        JOBS.submit('save', lambda progress: save_map(snapshot, path))
+
+def load_dialog():
+    path = filedialog.askopenfilename(filetypes=[('Map', '*.umap')])
+    if path:
+        JOBS.submit('load', lambda progress: load_map(path, main), opened)
+
+def opened(m):
+    global cmap
+    cmap = m
 
-    if cmap.objects: code += name+':design({\n'+design+'})\n'
-    if cmap.images_bg + cmap.images_bg: code += name+':decorate({\n'+decorate+'})'
-    
-    size = len(code)
-    print('[INFO] Map built successfully!')
-    print('[STATS] Name        : ', name)
-    print('[STATS] Lines       : ', lines)
-    print('[STATS] Size        : ', size)
-    print('[STATS] Build time  : ', round(time.time()-start, 4),'\n')
-    print(code)
-    return(code)
-        
-    
 NATURE = {
     'Grasses':{
         'HighGrass':lambda: New1('assets/nature/grass1.png', 'highgrass'),
@@ -583,67 +1141,80 @@ IMAGES_BG = {
 cmap = None
 csprite = lambda: New1('assets/player/default1.png', 'player')
 ERASE = False
+TOOL = 'Paint'
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(cli()) #same commands as python -m mapcore
+    print('[INFO] Starting map editor...')
+    root = Tk()
+    root.title('Map Editor')
+    if sys.platform == 'win32':
+        root.iconbitmap('assets/icons/icon128.ico')
+    else: #X11 Tk only takes .xbm bitmaps
+        root.iconphoto(True, PhotoImage(file='assets/icons/icon128.png'))
+    root.configure(bg='gray10')
+    embed = Frame(root, width = WINDOW_WIDTH, height = WINDOW_HEIGHT)
+    embed.pack(expand=True, fill='both', side='right')
+    tools = Frame(root, width = 100, height = WINDOW_HEIGHT, bg='gray10')
+    tools.pack(side='left')
+    var = StringVar(tools)
+    var.set("select")
+
+    tree=ttk.Treeview(tools, height=20, columns=('size',))
+    tree.bind("<<TreeviewSelect>>", tree_select)
+    tree.bind("<<TreeviewOpen>>", lambda event: CATALOG.open(tree, tree.focus()))
+    tree.heading('#0', text='Sprite')
+    tree.heading('size', text='Size')
+    tree.column('size', width=60)
+    build_tree()
+    tree.grid(row=0, column=1, columnspan=2)
+
+    ysb = ttk.Scrollbar(tools, orient='vertical', command=tree.yview)
+    xsb = ttk.Scrollbar(tools, orient='horizontal', command=tree.xview)
+
+    lb1 = Label(tools, text='tool   :', bg='gray10', fg='white', font=('Courier', 12))
+    option1 = OptionMenu(tools, var, 'Paint','Erase','Brush','Select','Fill','Rect', command=selected_t)
+    #ttk.Separator(tools, orient=HORIZONTAL).grid(row=0, columnspan=3, sticky="ew")
+    lb1.grid(row=1, column=1)
+    option1.grid(row=1, column=2)
+
+    lb2 = Label(tools, text='decorate :', bg='gray10', fg='white', font=('Courier', 12))
+    option2 = OptionMenu(tools, var, *IMAGES_BG.keys(), command=selected_b)
+    color = Entry(tools)
+    lb2.grid(row=2, column=1)
+    option2.grid(row=2, column=2)
+
+    build_btn = None
+    #color.grid(row=2, column=2)
+    #option1.options(*IMAGES_BG.keys())
+
+    menubar = Menu(root)
+    filemenu = Menu(menubar, tearoff=0)
+    filemenu.add_command(label="New Map", command = new_map)
+    filemenu.add_command(label="Load Map", command = load_dialog)
+    filemenu.add_command(label="Save Map", command = save_dialog)
+    filemenu.add_command(label="Export Map", command = lambda: save_lua(export_map))
+    filemenu.add_command(label="Build Map", command = lambda: save_lua(build_map))
+    filemenu.add_separator()
+    filemenu.add_command(label="Exit", command=quit)
+    menubar.add_cascade(label="File", menu=filemenu)
+
+    settingsmenu = Menu(menubar, tearoff=0)
+    settingsmenu.add_command(label='Clear Screen')
+    settingsmenu.add_command(label='Toggle Dark Mode')
+    menubar.add_cascade(label="Options", menu=settingsmenu)
+
+    helpmenu = Menu(menubar, tearoff=0)
+    helpmenu.add_command(label="About")
+    menubar.add_cascade(label="Help", menu=helpmenu)
+    root.config(menu=menubar)
+
+
+    os.environ['SDL_WINDOWID'] = str(embed.winfo_id())
+    if video_driver():
+        os.environ.setdefault('SDL_VIDEODRIVER', video_driver())
 
-root = Tk()
-root.title('Map Editor')
-root.iconbitmap('assets/icons/icon128.ico')
-root.configure(bg='gray10')
-embed = Frame(root, width = WINDOW_WIDTH, height = WINDOW_HEIGHT)
-embed.pack(expand=True, fill='both', side='right')
-tools = Frame(root, width = 100, height = WINDOW_HEIGHT, bg='gray10')
-tools.pack(side='left')
-var = StringVar(tools)
-var.set("select")
-
-tree=ttk.Treeview(tools, height=20)
-tree.bind("<<TreeviewSelect>>", tree_select)
-tree.heading('#0', text='Sprite')
-build_tree()
-tree.grid(row=0, column=1, columnspan=2)
-
-ysb = ttk.Scrollbar(tools, orient='vertical', command=tree.yview)
-xsb = ttk.Scrollbar(tools, orient='horizontal', command=tree.xview)
-
-lb1 = Label(tools, text='tool   :', bg='gray10', fg='white', font=('Courier', 12))
-option1 = OptionMenu(tools, var, 'Paint','Erase', command=selected_t)
-#ttk.Separator(tools, orient=HORIZONTAL).grid(row=0, columnspan=3, sticky="ew")
-lb1.grid(row=1, column=1)
-option1.grid(row=1, column=2)
-
-lb2 = Label(tools, text='decorate :', bg='gray10', fg='white', font=('Courier', 12))
-option2 = OptionMenu(tools, var, *IMAGES_BG.keys(), command=selected_b)
-color = Entry(tools)
-lb2.grid(row=2, column=1)
-option2.grid(row=2, column=2)
-
-build_btn = None
-#color.grid(row=2, column=2)
-#option1.options(*IMAGES_BG.keys())
-
-menubar = Menu(root)
-filemenu = Menu(menubar, tearoff=0)
-filemenu.add_command(label="New Map", command = new_map)
-filemenu.add_command(label="Load Map", state=DISABLED)
-filemenu.add_command(label="Save Map", command = export_map)
-filemenu.add_command(label="Build Map", command = build_map)
-filemenu.add_separator()
-filemenu.add_command(label="Exit", command=quit)
-menubar.add_cascade(label="File", menu=filemenu)
-
-settingsmenu = Menu(menubar, tearoff=0)
-settingsmenu.add_command(label='Clear Screen')
-settingsmenu.add_command(label='Toggle Dark Mode')
-menubar.add_cascade(label="Options", menu=settingsmenu)
-
-helpmenu = Menu(menubar, tearoff=0)
-helpmenu.add_command(label="About")
-menubar.add_cascade(label="Help", menu=helpmenu)
-root.config(menu=menubar)
-
-
-os.environ['SDL_WINDOWID'] = str(embed.winfo_id())
-os.environ['SDL_VIDEODRIVER'] = 'windib'
-
-print('[INFO] Starting main loop')
-main = Editor()
-main.start()
+    print('[INFO] Starting main loop')
+    main = Editor()
+    main.start()
@@ -0,0 +1,167 @@
+#========================================
+#   MAP CORE BENCHMARK
+#   draw, hit-test, export and memory on synthetic maps, headless
+#   usage: python benchmarks/bench_core.py [--sizes 1000 10000 ...] [--out run.json] [--compare old.json]
+#========================================
+
+import io
+import gc
+import json
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+
+from common import editor, pygame, Game, synthetic, percentile
+
+try:
+    import resource
+except ImportError: #not on Windows
+    resource = None
+
+def timings(func, repeat):
+    '''Milliseconds taken by each of repeat calls'''
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(i)
+        times += [(time.perf_counter()-start)*1000]
+    return times
+
+def summary(times):
+    return {'p50': round(percentile(times, 50), 4), 'p99': round(percentile(times, 99), 4), 'mean': round(sum(times)/len(times), 4)}
+
+def bench_size(game, count, frames, hits):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    cmap = synthetic(game, count)
+    build_s = time.perf_counter()-start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rng = random.Random(0)
+    width, height = game.display_surface.get_size()
+    side = cmap.size[0]
+    def pan(step):
+        '''Camera positions drifting across the map by step pixels a frame, bouncing off the edges'''
+        x, y = rng.randint(0, max(0, side-width)), rng.randint(0, max(0, side-height))
+        dx, dy = step, step*0.6
+        path = []
+        for _ in range(frames):
+            if not 0 <= x+dx <= side-width:
+                dx = -dx
+            if not 0 <= y+dy <= side-height:
+                dy = -dy
+            x, y = x+dx, y+dy
+            path += [(int(x), int(y))]
+        return path
+    def frame(i):
+        cmap.camx, cmap.camy = -path[i][0], -path[i][1]
+        game.display_surface.fill(editor.BACKGROUND)
+        cmap.update()
+    path = pan(8)
+    frame(0)
+    draw = timings(frame, frames)
+    path = [(rng.randint(0, max(0, side-width)), rng.randint(0, max(0, side-height))) for _ in range(frames)]
+    jump = timings(frame, frames)
+    cmap.zoom_to(editor.ZOOM_MIN, 0, 0)
+    cmap.camx = cmap.camy = 0
+    zoomed = timings(lambda i: (game.display_surface.fill(editor.BACKGROUND), cmap.update()), frames)
+    cmap.zoom_to(0, 0, 0)
+
+    points = [(rng.randint(0, side), rng.randint(0, side)) for _ in range(hits)]
+    cmap.camx = cmap.camy = 0
+    hit = timings(lambda i: [cmap.hit(layer, *points[i]) for layer in cmap.LAYERS], hits)
+    brush = timings(lambda i: cmap.query_radius(points[i][0], points[i][1], editor.BRUSH_RADIUS), hits)
+
+    start = time.perf_counter()
+    pairs = sum(1 for pair in cmap.overlap_pairs())
+    overlap_s = time.perf_counter()-start
+
+    exports = {}
+    for name, export in (('export_map', editor.export_map), ('build_map', editor.build_map)):
+        out = io.StringIO()
+        start = time.perf_counter()
+        size = export(out=out, m=cmap, stats=False)
+        took = time.perf_counter()-start
+        exports[name] = {'seconds': round(took, 4), 'placements_per_s': round(count/took), 'mb_per_s': round(size/took/1e6, 2)}
+
+    return {
+        'placements': count,
+        'map_size': cmap.size,
+        'build_s': round(build_s, 4),
+        'memory_bytes': current,
+        'memory_peak_bytes': peak,
+        'bytes_per_placement': round(current/max(count, 1), 1),
+        'draw_ms': summary(draw),
+        'jump_draw_ms': summary(jump),
+        'zoomed_out_draw_ms': summary(zoomed),
+        'visible': sum(len(cmap.visible(layer)) for layer in cmap.LAYERS),
+        'hit_ms': summary(hit),
+        'brush_query_ms': summary(brush),
+        'overlap_pairs': pairs,
+        'overlap_s': round(overlap_s, 4),
+        'export': exports,
+    }
+
+def compare(old, new):
+    '''Print new/old ratios for the timings both runs share'''
+    before = {r['placements']: r for r in old['results']}
+    print('[COMPARE] placements | draw p50 | draw p99 | hit p50 | export_map s | build_map s  (new/old, <1 is faster)')
+    for r in new['results']:
+        o = before.get(r['placements'])
+        if o is None:
+            continue
+        ratio = lambda a, b: round(a/b, 2) if b else float('nan')
+        print('[COMPARE] {:>10} | {:>8} | {:>8} | {:>7} | {:>12} | {:>11}'.format(
+            r['placements'],
+            ratio(r['draw_ms']['p50'], o['draw_ms']['p50']),
+            ratio(r['draw_ms']['p99'], o['draw_ms']['p99']),
+            ratio(r['hit_ms']['p50'], o['hit_ms']['p50']),
+            ratio(r['export']['export_map']['seconds'], o['export']['export_map']['seconds']),
+            ratio(r['export']['build_map']['seconds'], o['export']['build_map']['seconds'])))
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless benchmarks of the map editor core')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--hits', type=int, default=500)
+    parser.add_argument('--out', default='bench_output.json')
+    parser.add_argument('--compare', help='earlier JSON result to compare against')
+    parser.add_argument('--atlas', action='store_true', help='pack the sprites into an atlas first, like the editor does')
+    args = parser.parse_args()
+
+    game = Game()
+    if args.atlas:
+        editor.ATLAS.build(editor.CATALOG.images())
+    results = []
+    for count in args.sizes:
+        print('[INFO] Benchmarking', count, 'placements')
+        results += [bench_size(game, count, args.frames, args.hits)]
+        r = results[-1]
+        print('[STATS] draw p50/p99 {} / {} ms, hit p50 {} ms, export {} placements/s, {} bytes/placement'.format(
+            r['draw_ms']['p50'], r['draw_ms']['p99'], r['hit_ms']['p50'], r['export']['export_map']['placements_per_s'], r['bytes_per_placement']))
+
+    run = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pygame': pygame.version.ver,
+            'platform': platform.platform(),
+            'window': [editor.WINDOW_WIDTH, editor.WINDOW_HEIGHT],
+            'atlas': editor.ATLAS.stats(),
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None,
+        },
+        'results': results,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(run, f, indent=2)
+    print('[INFO] Results written to', args.out)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), run)
+
+if __name__ == '__main__':
+    main()
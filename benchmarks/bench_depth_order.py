@@ -0,0 +1,49 @@
+#========================================
+#   DEPTH ORDER BENCHMARK
+#   sorted() every frame vs the DepthGrid kept by Map
+#========================================
+
+import time
+import random
+
+from common import editor, Game
+
+SIZES = (1000, 10000, 100000)
+FRAMES = 20
+MAP_SIZE = 20000
+SPRITES = ('assets/nature/grass1.png', 'assets/nature/tree1.png', 'assets/nature/flowerw.png', 'assets/nature/mediumbush1.png')
+
+def per_frame(func):
+    start = time.perf_counter()
+    for _ in range(FRAMES):
+        func()
+    return (time.perf_counter()-start)/FRAMES*1000
+
+def run(game, count):
+    random.seed(count)
+    cmap = editor.Map(game, (MAP_SIZE, MAP_SIZE))
+    objs = [editor.New1(random.choice(SPRITES), 'bench').at(random.randint(0, MAP_SIZE), random.randint(0, MAP_SIZE)) for _ in range(count)]
+    start = time.perf_counter()
+    cmap.design(objs)
+    insert = (time.perf_counter()-start)*1000
+    rows = list(cmap.rows('objects'))
+    depth = lambda row: cmap.ys[row] + cmap.types[cmap.type_ids[row]].height
+    everything = (0, 0, MAP_SIZE, MAP_SIZE)
+    grid = cmap.grids['objects']
+    return {
+        'objects': count,
+        'insert ms': insert,
+        'sorted() ms/frame': per_frame(lambda: sorted(rows, key=depth)),
+        'grid all ms/frame': per_frame(lambda: grid.query(*everything)),
+        'grid view ms/frame': per_frame(lambda: cmap.visible('objects')),
+    }
+
+def main():
+    game = Game()
+    rows = [run(game, count) for count in SIZES]
+    print(' | '.join('{:>18}'.format(key) for key in rows[0]))
+    for row in rows:
+        print(' | '.join('{:>18}'.format(round(value, 3)) for value in row.values()))
+
+if __name__ == '__main__':
+    main()
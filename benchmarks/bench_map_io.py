@@ -0,0 +1,92 @@
+#========================================
+#   MAP FILE BENCHMARK
+#   open time of the binary map format vs reading the Lua build output
+#   usage: python benchmarks/bench_map_io.py [placements]
+#========================================
+
+import os
+import re
+import sys
+import time
+import tempfile
+
+from common import editor, Game, synthetic
+
+MAP_SIZE = 20000
+LINE = re.compile(r'(\w*)\.new\(\):at\((-?\d+), (-?\d+)(?:, (true|false))?\)')
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, (time.perf_counter()-start)*1000
+
+def parse_lua(path):
+    with open(path) as f:
+        return [(name, int(x), int(y), z == 'true') for name, x, y, z in LINE.findall(f.read())]
+
+def columns(m, dead=False):
+    '''Every placement of m as (sprite, mapx, mapy, layer code) per row, with the counts and
+    ground tiles. Erased rows are kept with dead, a plain save leaves them out'''
+    sprites = [(t.layer, t.name, os.path.normpath(t.path)) for t in m.types]
+    rows = [row for row in range(len(m.layer_ids)) if dead or m.layer_ids[row] != editor.DEAD]
+    placements = [(sprites[m.type_ids[row]], m.xs[row], m.ys[row], m.layer_ids[row]) for row in rows]
+    return placements, dict(m.counts), (m.tiles.cols, m.tiles.rows), bytes(m.tiles.cells), list(m.tiles.types)
+
+def check(a, b, what, dead=False):
+    '''Stop if b does not hold the same rows as a, or exports to different Lua'''
+    if columns(a, dead) != columns(b, dead):
+        raise SystemExit('[ERROR] {} changed the placement columns'.format(what))
+    if editor.build_map(m=a, stats=False) != editor.build_map(m=b, stats=False):
+        raise SystemExit('[ERROR] {} changed the Lua output'.format(what))
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    game = Game()
+    cmap = synthetic(game, count, MAP_SIZE)
+    grass = cmap.tile_type(editor.Tile('assets/tiles/grass.png', 'grass'))
+    dirt = cmap.tile_type(editor.Tile('assets/tiles/dirt.png', 'dirt'))
+    def ground():
+        cmap.fill_tiles((0, 0, MAP_SIZE, MAP_SIZE), grass)
+        cmap.fill_tiles((MAP_SIZE//4, MAP_SIZE//4, MAP_SIZE//3, MAP_SIZE//3), dirt)
+        cmap.flood_tiles(0, 0, dirt)
+    _, tiles_ms = timed(ground)
+    cmap.erase_many(range(0, count, 100)) #a plain save drops erased rows
+    with tempfile.TemporaryDirectory() as folder:
+        binary = os.path.join(folder, 'bench.umap')
+        lua = os.path.join(folder, 'bench.lua')
+        _, save_ms = timed(lambda: editor.save_map(cmap, binary))
+        with open(lua, 'w', newline='') as f:
+            editor.build_map(out=f, m=cmap, stats=False)
+
+        loaded, open_ms = timed(lambda: editor.load_map(binary, game))
+        _, view_ms = timed(loaded.update)
+        _, realize_ms = timed(loaded.realize_all)
+        parsed, lua_ms = timed(lambda: parse_lua(lua))
+        check(cmap, loaded, 'round trip')
+
+        binary_size, lua_size = os.path.getsize(binary), os.path.getsize(lua)
+
+        autosave = editor.Autosave(loaded, os.path.join(folder, 'autosave'), interval=0)
+        rows = [loaded.add(loaded.type_ids[n], loaded.xs[n]+8, loaded.ys[n]+8) for n in range(0, count, 20)]
+        loaded.erase_many(rows[::2])
+        autosave.tick()
+        autosave.close()
+        recovered, recover_ms = timed(lambda: editor.recover(os.path.join(folder, 'autosave'), game))
+        recovered.realize_all()
+        check(loaded, recovered, 'autosave recovery', dead=True)
+        everything = (-MAP_SIZE, -MAP_SIZE, 3*MAP_SIZE, 3*MAP_SIZE)
+        if sorted(recovered.query_rect(everything)) != sorted(loaded.query_rect(everything)):
+            raise SystemExit('[ERROR] autosave recovery changed the spatial index')
+
+    print('[STATS] Placements      : ', count, '(', sum(cmap.counts.values()), 'left after erasing,', len(parsed), 'in Lua )')
+    print('[STATS] File size       : ', binary_size, 'bytes binary,', lua_size, 'bytes Lua')
+    print('[STATS] Ground tiles    : ', cmap.tiles.count, 'cells filled in', round(tiles_ms, 1), 'ms')
+    print('[STATS] Save            : ', round(save_ms, 1), 'ms')
+    print('[STATS] Open            : ', round(open_ms, 1), 'ms')
+    print('[STATS] First frame     : ', round(view_ms, 1), 'ms')
+    print('[STATS] Realize all     : ', round(realize_ms, 1), 'ms')
+    print('[STATS] Parse Lua text  : ', round(lua_ms, 1), 'ms')
+    print('[STATS] Recover autosave: ', round(recover_ms, 1), 'ms (', len(rows) + len(rows[::2]), 'edits replayed )')
+
+if __name__ == '__main__':
+    main()
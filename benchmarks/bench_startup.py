@@ -0,0 +1,42 @@
+#========================================
+#   STARTUP BENCHMARK
+#   cost of importing the headless map core vs the editor module, and of the
+#   python -m mapcore commands on a saved map, each in a fresh interpreter
+#   usage: python benchmarks/bench_startup.py [placements] [runs]
+#========================================
+
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+from common import ROOT, editor, Game, synthetic
+
+def wall(args, runs):
+    '''Median wall time in ms of running python with args from the repository root'''
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=ROOT, check=True, stdout=subprocess.DEVNULL, env=dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT='1'))
+        times += [(time.perf_counter()-start)*1000]
+    return sorted(times)[len(times)//2]
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    lazy = subprocess.run([sys.executable, '-c', 'import sys, mapcore; sys.exit("pygame" in sys.modules)'], cwd=ROOT).returncode == 0
+    print('[STATS] import mapcore leaves pygame unloaded:', lazy)
+    python_ms = wall(['-c', 'pass'], runs)
+    core_ms = wall(['-c', 'import mapcore'], runs)
+    editor_ms = wall(['-c', 'import MapEditor'], runs)
+    print('[STATS] interpreter {:.1f} ms, import mapcore +{:.1f} ms, import MapEditor +{:.1f} ms'.format(python_ms, core_ms-python_ms, editor_ms-python_ms))
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'bench.umap')
+        editor.save_map(synthetic(Game(), count), path)
+        for command in ('stats', 'validate', 'export'):
+            args = ['-m', 'mapcore', command, path] + (['-o', folder, '-j', '1'] if command == 'export' else [])
+            print('[STATS] python -m mapcore {} ({} placements): {:.1f} ms'.format(command, count, wall(args, runs)))
+
+if __name__ == '__main__':
+    main()
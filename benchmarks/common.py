@@ -0,0 +1,49 @@
+#========================================
+#   BENCHMARK HELPERS
+#   shared by the scripts in this folder, runs the map core headless
+#========================================
+
+import os
+import sys
+import random
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import pygame
+import MapEditor as editor
+
+DENSITY = 64 #one placement per DENSITY x DENSITY map pixels on average
+
+class Game:
+    '''Stands in for the Editor: just a display surface on the dummy video driver'''
+    def __init__(self, size=(editor.WINDOW_WIDTH, editor.WINDOW_HEIGHT)):
+        pygame.init()
+        self.display_surface = pygame.display.set_mode(size)
+
+def factories():
+    '''Every sprite factory in the catalog, i.e. the shipped assets/nature and player sprites'''
+    return [factory for group in editor.NATURE.values() for factory in group.values()]
+
+def side_for(count):
+    return max(editor.WINDOW_WIDTH, int(DENSITY*count**0.5))
+
+def synthetic(game, count, size=None, seed=None):
+    '''A map with count random placements. Types are registered once, rows are added directly'''
+    rng = random.Random(count if seed is None else seed)
+    size = side_for(count) if size is None else size
+    cmap = editor.Map(game, (size, size))
+    cmap.name = 'bench'
+    types = [cmap.type_of(factory()) for factory in factories()]
+    for _ in range(count):
+        cmap.add(rng.choice(types), rng.randint(0, size), rng.randint(0, size))
+    return cmap
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values)-1, int(round(p/100*(len(values)-1))))]
@@ -0,0 +1,2377 @@
+#========================================
+#   MAP CORE
+#   the map model, the map file format and the Lua exporters. Usable without
+#   Tk or a window: pygame is imported when something first needs it and
+#   sprite images are only decoded when their size or pixels are asked for
+#========================================
+
+import os
+import io
+import sys
+import re
+import time
+import math
+import mmap
+import struct
+import importlib
+import threading
+from array import array
+from bisect import insort, bisect_left, bisect_right
+from itertools import chain, compress
+from heapq import merge
+from collections import OrderedDict, Counter, deque
+
+class LazyModule:
+    '''Stands in for a module until one of its attributes is used'''
+    def __init__(self, name):
+        self.__name = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name)
+        globals()[self.__name] = module
+        return getattr(module, attr)
+
+pygame = LazyModule('pygame')
+
+BACKGROUND = (10,10,10)
+
+EXPORT_BUFFER = 1 << 16
+EXPORT_WORKERS = os.cpu_count() or 1
+PARALLEL_EXPORT_MIN = 200000 #smaller maps export faster on one core than it takes to start the workers
+CHUNK_SIZE = 512
+CHUNK_BUDGET = 64 << 20
+CHUNK_BUILD_BUDGET = 8 #ms per frame spent building zoomed out chunks, the rest show up on later frames
+STALE_LIMIT = 64 #edits patched into a points chunk before it is rebuilt instead
+MIP_BUDGET = 32 << 20
+ZOOM_MIN = -8 #zoom levels are powers of two: 2**-8 .. 2**2
+ZOOM_MAX = 2
+POINT_LEVEL = -3 #at this zoom and below everything is drawn as points into cached chunks
+TILE_SIZE = 32 #map pixels per side of a ground tile cell
+ATLAS_PAGE = 1024 #side of an atlas page, larger images stay on their own
+ATLAS_PADDING = 1
+ATLAS_VERSION = 1
+AUTOSAVE_INTERVAL = 1.0 #seconds between handing logged edits to the autosave writer
+AUTOSAVE_COMPACT = 4 << 20 #bytes of logged edits before the map is snapshotted again
+JOURNAL_BUDGET = 4 << 20
+ERASE_SLICE = 4096
+PROFILE_FRAMES = 240
+PROFILE_TRACE_LIMIT = 1 << 20
+
+class Profiler:
+    '''Per-frame section timings and counters, kept for the last PROFILE_FRAMES frames
+    and optionally recorded as Chrome trace events (chrome://tracing, Perfetto).
+    While disabled start() and stop() only check a flag'''
+    def __init__(self, frames=PROFILE_FRAMES):
+        self.enabled = False
+        self.frames = deque(maxlen=frames)
+        self.times = {}
+        self.counts = {}
+        self.totals = {}
+        self.last_times = {}
+        self.last_counts = {}
+        self.frame_start = time.perf_counter()
+        self.events = None
+
+    def start(self):
+        return time.perf_counter() if self.enabled else 0
+
+    def stop(self, name, start):
+        '''Add the time since start to section name. Returns the current time to chain sections'''
+        if not self.enabled or not start: #a section that began while disabled is dropped
+            return 0
+        now = time.perf_counter()
+        self.times[name] = self.times.get(name, 0) + (now-start)*1000
+        if self.events is not None and len(self.events) < PROFILE_TRACE_LIMIT:
+            self.events += [{'name': name, 'ph': 'X', 'ts': start*1e6, 'dur': (now-start)*1e6, 'pid': os.getpid(), 'tid': threading.get_ident()}]
+        return now
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def tally(self, name, total):
+        '''Count the growth of an ever increasing total, like a cache's hits, since the last frame'''
+        if self.enabled:
+            self.counts[name] = total - self.totals.get(name, total)
+            self.totals[name] = total
+
+    def frame(self):
+        '''Close the frame: keep its time without the 'idle' section, then start the next one'''
+        now = time.perf_counter()
+        if self.enabled:
+            self.frames += [(now-self.frame_start)*1000 - self.times.get('idle', 0)]
+            if self.events is not None and self.counts and len(self.events) < PROFILE_TRACE_LIMIT:
+                self.events += [{'name': 'counters', 'ph': 'C', 'ts': now*1e6, 'pid': os.getpid(), 'args': self.counts}]
+            self.last_times, self.last_counts = self.times, self.counts
+            self.times, self.counts = {}, {}
+        self.frame_start = now
+
+    def percentile(self, p):
+        if not self.frames:
+            return 0
+        frames = sorted(self.frames)
+        return frames[min(len(frames)-1, len(frames)*p//100)]
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self.frames.clear()
+        self.totals = {}
+
+    def record(self):
+        '''Start keeping trace events, enabling the profiler if needed'''
+        self.enabled = True
+        self.events = []
+
+    def dump(self, path):
+        '''Write the recorded events as a Chrome trace JSON file and stop recording'''
+        import json
+        events, self.events = self.events or [], None
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        return len(events)
+
+PROFILE = Profiler()
+
+class AssetCache:
+    '''Decoded surfaces shared by every sprite that uses the same file'''
+    def __init__(self):
+        self.surfaces = {}
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(path, alpha=True, scale2x=False):
+        return (os.path.normpath(path), bool(alpha), bool(scale2x))
+
+    @staticmethod
+    def size_of(surface):
+        return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+    @staticmethod
+    def prepare(surface, alpha=True, scale2x=False):
+        if pygame.display.get_surface() is not None: #converting needs a window, headless callers keep the file's format
+            surface = surface.convert_alpha() if alpha else surface.convert()
+        if scale2x:
+            surface = pygame.transform.scale2x(surface)
+        return surface
+
+    def decode(self, key):
+        path, alpha, scale2x = key
+        return self.prepare(pygame.image.load(path), alpha, scale2x)
+
+    def insert(self, key, decoded):
+        with self.lock: #two callers may decode the same file, keep the first
+            surface = self.surfaces.setdefault(key, decoded)
+            if surface is decoded:
+                self.misses += 1
+                self.memory += self.size_of(surface)
+        return surface
+
+    def load(self, path, alpha=True, scale2x=False):
+        '''Return the shared surface for path, decoding it on first use. Callers must not draw on it'''
+        key = self.key(path, alpha, scale2x)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            return self.insert(key, self.decode(key))
+        self.hits += 1
+        return surface
+
+    def store(self, path, loaded, alpha=True, scale2x=False):
+        '''Share a surface another thread loaded from path with pygame.image.load, unless path
+        is cached already. Call it from the thread that draws, workers must never hold a shared surface'''
+        key = self.key(path, alpha, scale2x)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            return self.insert(key, self.prepare(loaded, alpha, scale2x))
+        self.hits += 1
+        return surface
+
+    def keys_for(self, path=None):
+        if path is None:
+            return list(self.surfaces)
+        path = os.path.normpath(path)
+        return [key for key in self.surfaces if key[0] == path]
+
+    def evict(self, path=None):
+        '''Forget the cached surfaces of path (every surface if None). Placed objects keep theirs'''
+        for key in self.keys_for(path):
+            self.memory -= self.size_of(self.surfaces.pop(key))
+
+    def adopt(self, path, surface):
+        '''Serve surface for path from now on, e.g. a subsurface of an atlas page'''
+        key = self.key(path)
+        with self.lock:
+            old = self.surfaces.get(key)
+            if old is not None:
+                self.memory -= self.size_of(old)
+            self.surfaces[key] = surface
+            self.memory += self.size_of(surface)
+
+    def reload(self, path=None):
+        '''Decode path again from disk. Surfaces of unchanged size are refreshed in place so placed objects see the new pixels'''
+        MIPS.clear()
+        MASKS.clear()
+        TILE_SURFACES.clear()
+        for key in self.keys_for(path):
+            old = self.surfaces[key]
+            new = self.decode(key)
+            if new.get_size() == old.get_size():
+                old.fill((0, 0, 0, 0))
+                old.blit(new, (0, 0), None, pygame.BLEND_RGBA_ADD)
+            else:
+                self.memory += self.size_of(new) - self.size_of(old)
+                self.surfaces[key] = new
+
+    def stats(self):
+        return {'surfaces': len(self.surfaces), 'memory': self.memory, 'hits': self.hits, 'misses': self.misses}
+
+ASSETS = AssetCache()
+
+def scaled(surface, size):
+    '''surface scaled to size, filtered when its format allows it'''
+    try:
+        return pygame.transform.smoothscale(surface, size)
+    except ValueError: #smoothscale only takes 24 and 32 bit surfaces
+        return pygame.transform.scale(surface, size)
+
+class MipCache:
+    '''Surfaces scaled by powers of two for the zoom levels. Each level is made from
+    the next one towards 1:1, on first use, and the least recently used are evicted
+    once over budget bytes'''
+    def __init__(self, budget=MIP_BUDGET):
+        self.budget = budget
+        self.surfaces = OrderedDict()
+        self.colors = {}
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, surface, level):
+        if level == 0:
+            return surface
+        key = (surface, level)
+        mip = self.surfaces.get(key)
+        if mip is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return mip
+        self.misses += 1
+        source = self.get(surface, level+1 if level < 0 else level-1)
+        width, height = source.get_size()
+        if level > 0:
+            mip = pygame.transform.scale(source, (width*2, height*2))
+        else:
+            mip = scaled(source, (max(1, width//2), max(1, height//2)))
+        self.surfaces[key] = mip
+        self.memory += AssetCache.size_of(mip)
+        while self.memory > self.budget and len(self.surfaces) > 1:
+            self.memory -= AssetCache.size_of(self.surfaces.popitem(False)[1])
+        return mip
+
+    def color(self, surface):
+        '''Average colour of surface, what it is drawn as at the point levels'''
+        color = self.colors.get(surface)
+        if color is None:
+            color = self.colors[surface] = pygame.transform.average_color(surface)[:3]
+        return color
+
+    def clear(self):
+        self.surfaces.clear()
+        self.colors.clear()
+        self.memory = 0
+
+    def stats(self):
+        return {'surfaces': len(self.surfaces), 'memory': self.memory, 'hits': self.hits, 'misses': self.misses}
+
+MIPS = MipCache()
+
+class MaskCache:
+    '''Collision masks of the shared sprite surfaces, made once per surface'''
+    def __init__(self):
+        self.masks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, surface):
+        mask = self.masks.get(surface)
+        if mask is None:
+            self.misses += 1
+            mask = self.masks[surface] = pygame.mask.from_surface(surface)
+        else:
+            self.hits += 1
+        return mask
+
+    def clear(self):
+        self.masks.clear()
+
+    def stats(self):
+        return {'masks': len(self.masks), 'hits': self.hits, 'misses': self.misses}
+
+MASKS = MaskCache()
+
+class Atlas:
+    '''Sprite images packed onto a few size x size pages, shelf by shelf from the
+    tallest. ASSETS serves each packed file as a subsurface of its page and source()
+    gives the renderer the page and area to blit. The packing is saved in a folder
+    and reused while the mtime and size of every file still match.
+    prepare only touches surfaces of its own so it can run on a worker, adopt hands
+    the pages to ASSETS and must run on the thread that draws. Types that already
+    took their surface only draw from the atlas once their map is rebound'''
+    def __init__(self, size=ATLAS_PAGE, padding=ATLAS_PADDING):
+        self.size = size
+        self.padding = padding
+        self.pages = []
+        self.regions = {}
+        self.areas = {}
+
+    def pack(self, sizes):
+        '''{path: (page, x, y)} for the (path, (width, height)) pairs in sizes that fit on a page'''
+        size, pad = self.size, self.padding
+        places = {}
+        page = x = y = shelf = 0
+        for path, (width, height) in sorted(sizes, key=lambda item: (-item[1][1], -item[1][0], item[0])):
+            if width+pad > size or height+pad > size:
+                continue
+            if x+width+pad > size:
+                x, y, shelf = 0, y+shelf, 0
+            if y+height+pad > size:
+                page, x, y, shelf = page+1, 0, 0, 0
+            places[path] = (page, x, y)
+            x += width+pad
+            shelf = max(shelf, height+pad)
+        return places
+
+    def prepare(self, paths, cache=None):
+        '''(pages, regions) packing the images at paths, or the packing saved in the
+        cache folder if it is still current. Safe on any thread, nothing is shared yet'''
+        stamps = {}
+        for path in paths:
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            stamps[os.path.normpath(path)] = [info.st_mtime, info.st_size]
+        packing = self.load(cache, stamps) if cache else None
+        if packing is None:
+            images = {}
+            for path in stamps:
+                try:
+                    images[path] = pygame.image.load(path) #a private copy, never the surface in ASSETS
+                except Exception as e:
+                    print('[INFO] Could not pack', path, repr(e))
+            places = self.pack([(path, image.get_size()) for path, image in images.items()])
+            extents = {}
+            for path, (page, x, y) in places.items():
+                extents[page] = max(extents.get(page, 0), y+images[path].get_height())
+            pages = [pygame.Surface((self.size, extents[page]), pygame.SRCALPHA) for page in sorted(extents)]
+            regions = {}
+            for path, (page, x, y) in places.items():
+                image = images[path]
+                pages[page].blit(image, (x, y), None, pygame.BLEND_RGBA_ADD) #onto clear pixels, copies alpha as is
+                regions[path] = (page, pygame.Rect((x, y), image.get_size()))
+            packing = pages, regions
+            if cache:
+                self.save(cache, stamps, *packing)
+        return packing
+
+    def adopt(self, pages, regions):
+        '''Add the pages from prepare and serve their sprites from ASSETS, on the thread
+        that draws. Returns the number of pages added'''
+        if pygame.display.get_surface() is not None:
+            pages = [page.convert_alpha() for page in pages]
+        first = len(self.pages)
+        self.pages += pages
+        for path, (page, rect) in regions.items():
+            self.regions[path] = (first+page, rect)
+            page = self.pages[first+page]
+            surface = page.subsurface(rect)
+            self.areas[surface] = (page, rect)
+            ASSETS.adopt(path, surface)
+        return len(pages)
+
+    def build(self, paths, cache=None):
+        '''prepare then adopt in one go, for callers without a worker'''
+        return self.adopt(*self.prepare(paths, cache))
+
+    def save(self, folder, stamps, pages, regions):
+        import json
+        try:
+            os.makedirs(folder, exist_ok=True)
+            for n, page in enumerate(pages):
+                pygame.image.save(page, os.path.join(folder, 'page{}.png'.format(n)))
+            with open(os.path.join(folder, 'index.json'), 'w') as f:
+                json.dump({'version': ATLAS_VERSION, 'size': self.size, 'padding': self.padding, 'pages': len(pages), 'sources': stamps,
+                           'regions': {path: [page, rect.x, rect.y, rect.width, rect.height] for path, (page, rect) in regions.items()}}, f, separators=(',', ':'))
+        except (OSError, pygame.error) as e:
+            print('[INFO] Could not write the atlas to', folder, e)
+
+    def load(self, folder, stamps):
+        '''Read the (pages, regions) saved in folder, None if there are none or the files changed since'''
+        import json
+        try:
+            with open(os.path.join(folder, 'index.json')) as f:
+                index = json.load(f)
+            if (index['version'], index['size'], index['padding'], index['sources']) != (ATLAS_VERSION, self.size, self.padding, stamps):
+                return None
+            pages = [pygame.image.load(os.path.join(folder, 'page{}.png'.format(n))) for n in range(index['pages'])]
+        except (OSError, ValueError, KeyError, pygame.error):
+            return None
+        return pages, {path: (page, pygame.Rect(x, y, width, height)) for path, (page, x, y, width, height) in index['regions'].items()}
+
+    def source(self, surface):
+        '''(surface to blit, area) that draws surface: its atlas page if it is packed'''
+        return self.areas.get(surface) or (surface, surface.get_rect())
+
+    def stats(self):
+        return {'pages': len(self.pages), 'sprites': len(self.regions), 'memory': sum(AssetCache.size_of(page) for page in self.pages)}
+
+ATLAS = Atlas()
+
+class SpatialGrid:
+    '''Uniform grid over map space holding placement rows. Rows are bucketed by
+    their centre, each bucket is kept in ascending row (placement) order and
+    queries are widened by the largest half extents inserted so far'''
+    def __init__(self, cell=256):
+        self.cell = cell
+        self.cells = {}
+        self.padx = 0
+        self.pady = 0
+        self.count = 0
+
+    def cell_of(self, x, y):
+        return (int(x//self.cell), int(y//self.cell))
+
+    def insert(self, row, x, y, width=0, height=0):
+        key = self.cell_of(x, y)
+        bucket = self.cells.get(key)
+        if bucket is None:
+            bucket = self.cells[key] = array('I')
+        if bucket and bucket[-1] > row:
+            insort(bucket, row)
+        else:
+            bucket.append(row)
+        self.padx = max(self.padx, width/2)
+        self.pady = max(self.pady, height/2)
+        self.count += 1
+
+    def remove(self, row, x, y):
+        key = self.cell_of(x, y)
+        bucket = self.cells.get(key)
+        if bucket:
+            i = bisect_left(bucket, row)
+            if i < len(bucket) and bucket[i] == row:
+                del bucket[i]
+                if not bucket:
+                    del self.cells[key]
+                self.count -= 1
+                return True
+        return False
+
+    def buckets(self, cx0, cy0, cx1, cy1):
+        if (cx1-cx0+1)*(cy1-cy0+1) > len(self.cells):
+            return [bucket for (cx, cy), bucket in self.cells.items() if cx0 <= cx <= cx1 and cy0 <= cy <= cy1]
+        found = []
+        for cy in range(cy0, cy1+1):
+            for cx in range(cx0, cx1+1):
+                bucket = self.cells.get((cx, cy))
+                if bucket:
+                    found += [bucket]
+        return found
+
+    def query(self, left, top, right, bottom):
+        '''Rows whose bounds may overlap the rectangle in placement order, callers do the exact test'''
+        cx0, cy0 = self.cell_of(left-self.padx, top-self.pady)
+        cx1, cy1 = self.cell_of(right+self.padx, bottom+self.pady)
+        found = self.buckets(cx0, cy0, cx1, cy1)
+        if len(found) == 1:
+            return list(found[0])
+        return list(merge(*found))
+
+class DepthGrid(SpatialGrid):
+    '''SpatialGrid keyed on (x, depth) whose buckets stay sorted by (depth, row),
+    so the visible rows come out in draw order without sorting every frame'''
+    def insert(self, row, x, z, width=0, height=0):
+        key = self.cell_of(x, z)
+        bucket = self.cells.get(key)
+        if bucket is None:
+            bucket = self.cells[key] = (array('i'), array('I'))
+        zs, rows = bucket
+        lo = bisect_left(zs, z)
+        i = bisect_left(rows, row, lo, bisect_right(zs, z, lo))
+        zs.insert(i, z)
+        rows.insert(i, row)
+        self.padx = max(self.padx, width/2)
+        self.pady = max(self.pady, height*1.5)
+        self.count += 1
+
+    def remove(self, row, x, z):
+        key = self.cell_of(x, z)
+        bucket = self.cells.get(key)
+        if bucket:
+            zs, rows = bucket
+            lo = bisect_left(zs, z)
+            i = bisect_left(rows, row, lo, bisect_right(zs, z, lo))
+            if i < len(rows) and rows[i] == row and zs[i] == z:
+                del zs[i]
+                del rows[i]
+                if not rows:
+                    del self.cells[key]
+                self.count -= 1
+                return True
+        return False
+
+    def query(self, left, top, right, bottom):
+        '''Candidates in ascending depth. A row keyed at depth z spans z-1.5h to z-0.5h'''
+        cx0, cy0 = self.cell_of(left-self.padx, top)
+        cx1, cy1 = self.cell_of(right+self.padx, bottom+self.pady)
+        rows = {}
+        if (cx1-cx0+1)*(cy1-cy0+1) > len(self.cells):
+            for (cx, cy), bucket in self.cells.items():
+                if cx0 <= cx <= cx1 and cy0 <= cy <= cy1:
+                    rows.setdefault(cy, []).append(bucket)
+        else:
+            for cy in range(cy0, cy1+1):
+                for cx in range(cx0, cx1+1):
+                    bucket = self.cells.get((cx, cy))
+                    if bucket:
+                        rows.setdefault(cy, []).append(bucket)
+        found = []
+        for cy in sorted(rows):
+            row = rows[cy]
+            if len(row) == 1:
+                found += row[0][1]
+            else:
+                found += [entry[1] for entry in merge(*[zip(*bucket) for bucket in row])]
+        return found
+
+class SpriteType:
+    '''Data shared by every placement of one sprite: name, asset, layer, surface and anchor.
+    Without an image the surface is loaded the first time it or its size is used'''
+    __slots__ = ('id', 'layer', 'name', 'path', 'image', 'source', 'width', 'height', 'ox', 'oy')
+    def __init__(self, id, layer, name, path, image=None):
+        self.id = id
+        self.layer = layer
+        self.name = name
+        self.path = path
+        if image is not None:
+            self.set_image(image)
+
+    def set_image(self, image):
+        self.image = image
+        self.source = ATLAS.source(image)
+        self.width = image.get_width()
+        self.height = image.get_height()
+        self.ox = self.width//2
+        self.oy = self.height//2
+
+    def __getattr__(self, attr):
+        if attr in ('image', 'source', 'width', 'height', 'ox', 'oy'):
+            self.set_image(ASSETS.load(self.path))
+            return getattr(self, attr)
+        raise AttributeError(attr)
+
+    @property
+    def z(self):
+        return self.layer == 'fg'
+
+    def bounds(self, x, y):
+        return pygame.Rect(x-self.ox, y-self.oy, self.width, self.height)
+
+class Placement:
+    '''View of one placed row for callers that want an object'''
+    __slots__ = ('map', 'row')
+    def __init__(self, m, row):
+        self.map = m
+        self.row = row
+
+    type = property(lambda self: self.map.types[self.map.type_ids[self.row]])
+    name = property(lambda self: self.type.name)
+    path = property(lambda self: self.type.path)
+    image = property(lambda self: self.type.image)
+    layer = property(lambda self: self.type.layer)
+    z = property(lambda self: self.type.z)
+    mapx = property(lambda self: self.map.xs[self.row])
+    mapy = property(lambda self: self.map.ys[self.row])
+    seq = property(lambda self: self.row)
+    z_index = property(lambda self: self.mapy + self.type.height)
+    bounds = property(lambda self: self.type.bounds(self.mapx, self.mapy))
+
+    def __eq__(self, other):
+        return isinstance(other, Placement) and other.map is self.map and other.row == self.row
+
+    def __hash__(self):
+        return hash((id(self.map), self.row))
+
+class LayerView:
+    '''The live placements of one layer in placement order'''
+    def __init__(self, m, layer):
+        self.map = m
+        self.layer = layer
+
+    def rows(self):
+        return self.map.rows(self.layer)
+
+    def last(self):
+        '''Most recently placed row. Raises IndexError when empty like list[-1]'''
+        code = LAYER_CODES[self.layer]
+        layers = self.map.layer_ids
+        for row in range(len(layers)-1, -1, -1):
+            if layers[row] == code:
+                return row
+        raise IndexError('layer is empty')
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __iter__(self):
+        return (Placement(self.map, row) for row in self.rows())
+
+    def __len__(self):
+        return self.map.counts[self.layer]
+
+LAYER_CODES = {'bg': 0, 'objects': 1, 'fg': 2}
+DEAD = 255
+
+TILE_RUN = re.compile(rb'(.)\1*', re.S) #a run of equal cells
+TILE_SURFACES = {}
+
+def tile_surface(path):
+    '''The image at path scaled to a TILE_SIZE cell, made once per file'''
+    surface = TILE_SURFACES.get(path)
+    if surface is None:
+        surface = ASSETS.load(path)
+        if surface.get_size() != (TILE_SIZE, TILE_SIZE):
+            surface = scaled(surface, (TILE_SIZE, TILE_SIZE))
+        TILE_SURFACES[path] = surface
+    return surface
+
+class TileLayer:
+    '''Ground tiles on a grid of size x size map pixel cells covering the map, one byte
+    per cell in row major order: 0 is empty, anything else an index into types. Edits
+    write the cells and return what they overwrote as (start, length, old tile) runs'''
+    def __init__(self, m, size=TILE_SIZE):
+        self.map = m
+        self.size = size
+        self.types = [None]
+        self.type_index = {}
+        self.cols = 0
+        self.rows = 0
+        self.cells = bytearray()
+        self.count = 0
+
+    def add_type(self, name, path):
+        '''Id of the tile, registering it on first use'''
+        key = (name, os.path.normpath(path))
+        tile = self.type_index.get(key)
+        if tile is None:
+            if len(self.types) > 255:
+                raise ValueError('a map holds at most 255 kinds of tile')
+            tile = self.type_index[key] = len(self.types)
+            self.types += [(name, path)]
+        return tile
+
+    def image(self, tile):
+        return tile_surface(self.types[tile][1])
+
+    def fit(self):
+        '''Size the grid to the map, keeping the tiles that still fit'''
+        cols, rows = -(-self.map.size[0]//self.size), -(-self.map.size[1]//self.size)
+        if (cols, rows) == (self.cols, self.rows):
+            return
+        cells = bytearray(cols*rows)
+        width = min(cols, self.cols)
+        for cy in range(min(rows, self.rows)):
+            cells[cy*cols:cy*cols+width] = self.cells[cy*self.cols:cy*self.cols+width]
+        self.cols, self.rows, self.cells = cols, rows, cells
+        self.count = len(cells) - cells.count(0)
+
+    def copy(self, m):
+        tiles = TileLayer(m, self.size)
+        tiles.types, tiles.type_index = list(self.types), dict(self.type_index)
+        tiles.cols, tiles.rows, tiles.cells, tiles.count = self.cols, self.rows, self.cells[:], self.count
+        return tiles
+
+    def cell_of(self, x, y):
+        '''Cell under the map point, None outside the grid'''
+        cx, cy = int(x//self.size), int(y//self.size)
+        if 0 <= cx < self.cols and 0 <= cy < self.rows:
+            return cx, cy
+        return None
+
+    def clamp(self, left, top, right, bottom):
+        '''Cell range (cx0, cy0, cx1, cy1), ends exclusive, of the cells overlapping the map rectangle'''
+        size = self.size
+        return max(0, int(left//size)), max(0, int(top//size)), min(self.cols, int((right-1)//size)+1), min(self.rows, int((bottom-1)//size)+1)
+
+    def area(self, start, length):
+        '''Map rect of a run of cells within one row'''
+        cy, cx = divmod(start, self.cols)
+        return pygame.Rect(cx*self.size, cy*self.size, length*self.size, self.size)
+
+    def get(self, cx, cy):
+        return self.cells[cy*self.cols+cx]
+
+    def spans(self, left, top, right, bottom):
+        '''(tile, cx, cy, length) for the runs of equal tiles along each row overlapping the map rectangle'''
+        if not self.count:
+            return
+        cx0, cy0, cx1, cy1 = self.clamp(left, top, right, bottom)
+        cells, cols = self.cells, self.cols
+        for cy in range(cy0, cy1):
+            row = cy*cols
+            for run in TILE_RUN.finditer(cells, row+cx0, row+cx1):
+                tile = cells[run.start()]
+                if tile:
+                    yield tile, run.start()-row, cy, run.end()-run.start()
+
+    def rects(self):
+        '''(tile, cx, cy, width, height) rectangles covering every tile: the runs along
+        each row, merged with the same run in the rows below'''
+        cells, cols = self.cells, self.cols
+        open = {}
+        for cy in range(self.rows):
+            row = cy*cols
+            runs = {}
+            for run in TILE_RUN.finditer(cells, row, row+cols):
+                tile = cells[run.start()]
+                if tile:
+                    key = (run.start()-row, run.end()-run.start(), tile)
+                    runs[key] = open.pop(key, cy)
+            for (cx, width, tile), top in open.items():
+                yield tile, cx, top, width, cy-top
+            open = runs
+        for (cx, width, tile), top in open.items():
+            yield tile, cx, top, width, self.rows-top
+
+    def write(self, start, length, tile):
+        '''Set length cells from start to tile'''
+        cells = self.cells
+        runs = [(run.start(), run.end()-run.start(), cells[run.start()]) for run in TILE_RUN.finditer(cells, start, start+length) if cells[run.start()] != tile]
+        cells[start:start+length] = bytes((tile,))*length
+        self.counted(runs, tile)
+        return runs
+
+    def counted(self, runs, tile):
+        for start, length, old in runs:
+            self.count += length*((tile != 0) - (old != 0))
+
+    def fill(self, cx0, cy0, cx1, cy1, tile):
+        '''Set the cells in the range, ends exclusive'''
+        runs = []
+        for cy in range(max(0, cy0), min(self.rows, cy1)):
+            left, right = max(0, cx0), min(self.cols, cx1)
+            if left < right:
+                runs += self.write(cy*self.cols+left, right-left, tile)
+        return runs
+
+    def flood(self, cx, cy, tile):
+        '''Set the 4-connected area of cells equal to the cell at (cx, cy), a row span at a time'''
+        cells, cols = self.cells, self.cols
+        old = cells[cy*cols+cx]
+        if old == tile:
+            return []
+        same, new = bytes((old,)), bytes((tile,))
+        inside = re.compile(re.escape(same)+b'+')
+        runs = []
+        seeds = [(cx, cy)]
+        while seeds:
+            x, y = seeds.pop()
+            row = y*cols
+            if cells[row+x] != old:
+                continue
+            left = len(cells[row:row+x].rstrip(same))
+            tail = cells[row+x:row+cols]
+            right = x + len(tail) - len(tail.lstrip(same))
+            cells[row+left:row+right] = new*(right-left)
+            runs += [(row+left, right-left, old)]
+            for ny in (y-1, y+1):
+                if 0 <= ny < self.rows:
+                    seeds += [(run.start()-ny*cols, ny) for run in inside.finditer(cells, ny*cols+left, ny*cols+right)]
+        self.counted(runs, tile)
+        return runs
+
+class ChunkCache:
+    '''The map base colour and background decorations composited into size x size
+    surfaces, keyed (cx, cy, zoom level). Chunks are built on first sight, dropped when
+    a background decoration inside them changes and evicted least recently used once
+    over budget bytes. At POINT_LEVEL chunks hold every layer drawn as points and are
+    patched in place on edits, further out they are made from the four chunks of the
+    level above'''
+    PENDING = 'pending'
+
+    def __init__(self, m, size=CHUNK_SIZE, budget=CHUNK_BUDGET):
+        self.map = m
+        self.size = size
+        self.budget = budget
+        self.chunks = OrderedDict()
+        self.stale = {}
+        self.levels = set()
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+
+    def span(self, level):
+        '''Map pixels covered by the side of a chunk at level'''
+        return self.size >> level if level > 0 else self.size << -level
+
+    def area(self, key):
+        span = self.span(key[2])
+        return pygame.Rect(key[0]*span, key[1]*span, span, span)
+
+    def keys(self, left, top, right, bottom, level=0):
+        span = self.span(level)
+        return [(cx, cy, level) for cy in range(int(top//span), int((bottom-1)//span)+1) for cx in range(int(left//span), int((right-1)//span)+1)]
+
+    def drop(self, key):
+        chunk = self.chunks.pop(key, None)
+        self.stale.pop(key, None)
+        if chunk is not None:
+            self.memory -= AssetCache.size_of(chunk)
+
+    def invalidate(self, rect=None, points=False):
+        '''Rebuild the chunks overlapping rect (every chunk if None) when next drawn.
+        With points only the point levels, which also show the other layers'''
+        if rect is None:
+            self.chunks.clear()
+            self.stale.clear()
+            self.levels.clear()
+            self.memory = 0
+            return
+        for level in list(self.levels):
+            if points and level > POINT_LEVEL:
+                continue
+            pad = self.span(level)//self.size #a point is at least a pixel wide
+            for key in self.keys(rect.left-pad, rect.top-pad, rect.right+pad, rect.bottom+pad, level):
+                if level == POINT_LEVEL and self.chunks.get(key) is not None and len(self.stale.get(key, ())) < STALE_LIMIT:
+                    self.stale.setdefault(key, []).append(rect)
+                else:
+                    self.drop(key)
+
+    def paint(self, chunk, key, rect):
+        '''Draw the part of chunk showing the map rect'''
+        m = self.map
+        level = key[2]
+        zoom = 2.0**level
+        area = self.area(key)
+        chunk.fill(BACKGROUND)
+        base = area.clip(pygame.Rect(0, 0, m.size[0], m.size[1]))
+        if base.width:
+            chunk.fill(m.color, (math.floor((base.left-area.left)*zoom), math.floor((base.top-area.top)*zoom), math.ceil(base.width*zoom), math.ceil(base.height*zoom)))
+        self.paint_tiles(chunk, area, rect, level)
+        types, type_ids, xs, ys = m.types, m.type_ids, m.xs, m.ys
+        if level == 0:
+            blits = []
+            for r in m.query_rect(rect, ('bg',)):
+                t = types[type_ids[r]]
+                surface, part = t.source
+                blits.append((surface, (xs[r]-t.ox-area.left, ys[r]-t.oy-area.top), part))
+            chunk.blits(blits, False)
+        elif level > POINT_LEVEL:
+            chunk.blits([(MIPS.get(types[type_ids[r]].image, level), (math.floor((xs[r]-types[type_ids[r]].ox-area.left)*zoom), math.floor((ys[r]-types[type_ids[r]].oy-area.top)*zoom))) for r in m.query_rect(rect, ('bg',))], False)
+        else:
+            fill = chunk.fill
+            color = MIPS.color
+            for layer in ('bg', 'objects', 'fg'):
+                for r in m.query_rect(rect, (layer,)):
+                    t = types[type_ids[r]]
+                    fill(color(t.image), (math.floor((xs[r]-t.ox-area.left)*zoom), math.floor((ys[r]-t.oy-area.top)*zoom), max(1, int(t.width*zoom)), max(1, int(t.height*zoom))))
+
+    def paint_tiles(self, chunk, area, rect, level):
+        '''Draw the ground tiles overlapping the map rect, a run of equal tiles at a time'''
+        tiles = self.map.tiles
+        size = tiles.size
+        zoom = 2.0**level
+        spans = tiles.spans(rect.left, rect.top, rect.right, rect.bottom)
+        if level <= POINT_LEVEL:
+            fill = chunk.fill
+            color = MIPS.color
+            height = max(1, math.ceil(size*zoom))
+            for tile, cx, cy, length in spans:
+                fill(color(tiles.image(tile)), (math.floor((cx*size-area.left)*zoom), math.floor((cy*size-area.top)*zoom), max(1, math.ceil(length*size*zoom)), height))
+            return
+        step = int(size*zoom)
+        blits = []
+        for tile, cx, cy, length in spans:
+            image = MIPS.get(tiles.image(tile), level)
+            left, top = int((cx*size-area.left)*zoom), int((cy*size-area.top)*zoom)
+            blits += [(image, (left+i*step, top)) for i in range(length)]
+        chunk.blits(blits, False)
+
+    def compose(self, key, deadline):
+        '''Shrink the four chunks of the level above into one'''
+        cx, cy, level = key
+        parts = [self.get((cx*2+i, cy*2+j, level+1), deadline) for j in (0, 1) for i in (0, 1)]
+        if self.PENDING in parts:
+            return self.PENDING
+        if not any(parts):
+            return None
+        half = self.size//2
+        chunk = pygame.Surface((self.size, self.size)).convert()
+        chunk.fill(BACKGROUND)
+        for i, part in enumerate(parts):
+            if part is not None:
+                chunk.blit(scaled(part, (half, half)), (i%2*half, i//2*half))
+        return chunk
+
+    def build(self, key, deadline=None):
+        m = self.map
+        if key[2] < POINT_LEVEL:
+            return self.compose(key, deadline)
+        area = self.area(key)
+        base = area.clip(pygame.Rect(0, 0, m.size[0], m.size[1]))
+        if not base.width and not m.query_rect(area, ('bg',) if key[2] > POINT_LEVEL else m.LAYERS):
+            return None
+        chunk = pygame.Surface((self.size, self.size)).convert()
+        self.paint(chunk, key, area)
+        return chunk
+
+    def get(self, key, deadline=None):
+        '''The chunk for key, None if it is empty. PENDING when it still had to be built
+        and deadline (a perf_counter time) has passed'''
+        if key in self.chunks:
+            self.hits += 1
+            self.chunks.move_to_end(key)
+            chunk = self.chunks[key]
+            if key in self.stale:
+                self.patch(key, chunk)
+            return chunk
+        if deadline is not None and time.perf_counter() > deadline:
+            return self.PENDING
+        self.misses += 1
+        chunk = self.build(key, deadline)
+        if chunk is self.PENDING:
+            return chunk
+        self.chunks[key] = chunk
+        self.levels.add(key[2])
+        if chunk is not None:
+            self.memory += AssetCache.size_of(chunk)
+            while self.memory > self.budget and len(self.chunks) > 1:
+                self.drop(next(iter(self.chunks)))
+        return chunk
+
+    def patch(self, key, chunk):
+        '''Repaint the edited parts of a points chunk'''
+        zoom = 2.0**key[2]
+        area = self.area(key)
+        for rect in self.stale.pop(key):
+            pad = area.width//self.size
+            rect = rect.inflate(pad*2, pad*2).clip(area)
+            chunk.set_clip((math.floor((rect.left-area.left)*zoom), math.floor((rect.top-area.top)*zoom), math.ceil(rect.width*zoom)+1, math.ceil(rect.height*zoom)+1))
+            self.paint(chunk, key, rect.inflate(pad*2, pad*2))
+        chunk.set_clip(None)
+
+    def draw(self, area=None):
+        '''Blit the chunks in view. Zoomed out, chunks left unbuilt once
+        CHUNK_BUILD_BUDGET is spent are marked damaged for the next frame'''
+        m = self.map
+        level = m.level
+        deadline = time.perf_counter() + CHUNK_BUILD_BUDGET/1000 if level <= POINT_LEVEL else None
+        blits = []
+        for key in self.keys(*m.view(area), level):
+            chunk = self.get(key, deadline)
+            if chunk is self.PENDING:
+                if m.damaged is not None:
+                    m.damaged += [self.area(key)]
+            elif chunk is not None:
+                blits += [(chunk, (key[0]*self.size+m.camx, key[1]*self.size+m.camy))]
+        m.game.display_surface.blits(blits, False)
+        PROFILE.count('blits', len(blits))
+
+class Journal:
+    '''Undo/redo history of a map's edits. A step is a flat array of (op, row, dx, dy)
+    records: rows are never reused so the row alone says what was added or erased,
+    moves keep their offset and tile records are (TILES, first cell, cells, old << 8 | new).
+    Edits between begin and end make one step, undo and redo wait until it is closed.
+    A job spread over frames records into a step of its own between enter and leave.
+    Oldest steps are dropped once the history is over budget bytes'''
+    ADD, ERASE, MOVE, TILES = 0, 1, 2, 3
+
+    def __init__(self, budget=JOURNAL_BUDGET):
+        self.budget = budget
+        self.undos = deque()
+        self.redos = []
+        self.memory = 0
+        self.step = None
+        self.depth = 0
+        self.replaying = False
+
+    def begin(self):
+        self.depth += 1
+        if self.step is None:
+            self.step = array('i')
+
+    def end(self):
+        if self.depth:
+            self.depth -= 1
+        if not self.depth:
+            self.commit()
+
+    def commit(self):
+        step, self.step = self.step, None
+        self.push(step)
+
+    def push(self, step):
+        if not step:
+            return
+        self.undos.append(step)
+        self.memory += sys.getsizeof(step)
+        for step in self.redos:
+            self.memory -= sys.getsizeof(step)
+        self.redos = []
+        while self.memory > self.budget and len(self.undos) > 1:
+            self.memory -= sys.getsizeof(self.undos.popleft())
+
+    def enter(self, step):
+        '''Record into step, a time-sliced job's own step, until leave(saved). Edits made
+        between its slices stay in theirs and push(step) adds it once the job is done'''
+        saved = self.step, self.depth
+        self.step, self.depth = step, 1
+        return saved
+
+    def leave(self, saved):
+        self.step, self.depth = saved
+
+    def record(self, op, row, dx=0, dy=0):
+        if self.replaying:
+            return
+        if self.step is None:
+            self.step = array('i', (op, row, dx, dy))
+            self.commit()
+        else:
+            self.step.extend((op, row, dx, dy))
+
+    def apply(self, m, step, backwards):
+        self.replaying = True
+        try:
+            for i in (range(len(step)-4, -1, -4) if backwards else range(0, len(step), 4)):
+                op, row, dx, dy = step[i:i+4]
+                if op == self.MOVE:
+                    sign = -1 if backwards else 1
+                    m.move(row, m.xs[row]+dx*sign, m.ys[row]+dy*sign)
+                elif op == self.TILES:
+                    m.tile_run(row, dx, dy >> 8 if backwards else dy & 255)
+                elif (op == self.ADD) == backwards:
+                    m.erase(row)
+                else:
+                    m.restore(row)
+        finally:
+            self.replaying = False
+
+    def undo(self, m):
+        '''Revert the last step, returns False if there is none or one is still open'''
+        if self.depth or not self.undos:
+            return False
+        step = self.undos.pop()
+        self.apply(m, step, True)
+        self.redos += [step]
+        return True
+
+    def redo(self, m):
+        '''Apply the last undone step again, returns False if there is none or one is still open'''
+        if self.depth or not self.redos:
+            return False
+        step = self.redos.pop()
+        self.apply(m, step, False)
+        self.undos.append(step)
+        return True
+
+class Map:
+    '''A map's placements, stored as columns: type id, mapx, mapy and layer code
+    per row. Rows are never reused, erasing marks the layer code DEAD'''
+    LAYERS = ('objects', 'fg', 'bg')
+
+    def __init__(self, game, size=(800,600)):
+        self.game = game
+        self.name = 'untitled'
+        self.size = size
+        self.camx = 0
+        self.camy = 0
+        self.level = 0
+        self.zoom = 1.0
+        self.color = (50, 130, 0)
+        self.types = []
+        self.type_index = {}
+        self.type_ids = array('I')
+        self.xs = array('i')
+        self.ys = array('i')
+        self.layer_ids = array('B')
+        self.counts = {'bg': 0, 'objects': 0, 'fg': 0}
+        self.objects = LayerView(self, 'objects')
+        self.images_fg = LayerView(self, 'fg')
+        self.images_bg = LayerView(self, 'bg')
+        self.grids = {'bg': SpatialGrid(), 'objects': DepthGrid(), 'fg': SpatialGrid()}
+        self.pending = {}
+        self.pending_order = None
+        self.tiles = TileLayer(self)
+        self.background = ChunkCache(self)
+        self.fitted = True
+        self.damaged = None
+        self.journal = None
+        self.autosave = None
+
+    def layer_of(self, obj):
+        '''Sprites (New1) are objects, images (New2) decorations in front if z is set'''
+        z = getattr(obj, 'z', None)
+        if z is None:
+            return 'objects'
+        return 'fg' if z else 'bg'
+
+    def add_type(self, layer, name, path):
+        '''Id of the sprite type, registering it on first use'''
+        key = (layer, name, os.path.normpath(path))
+        type_id = self.type_index.get(key)
+        if type_id is None:
+            type_id = self.type_index[key] = len(self.types)
+            self.types += [SpriteType(type_id, layer, name, path)]
+        return type_id
+
+    def type_of(self, obj):
+        return self.add_type(self.layer_of(obj), obj.name, obj.path)
+
+    def rebind(self, paths):
+        '''Have the types whose file is in paths take their surface from ASSETS again,
+        after it started serving them from the atlas'''
+        for t in self.types:
+            if os.path.normpath(t.path) in paths:
+                t.set_image(ASSETS.load(t.path))
+
+    def key(self, row):
+        '''Grid position of row, objects are keyed on their depth instead of mapy'''
+        t = self.types[self.type_ids[row]]
+        if t.layer == 'objects':
+            return self.xs[row], self.ys[row] + t.height
+        return self.xs[row], self.ys[row]
+
+    def bounds(self, row):
+        return self.types[self.type_ids[row]].bounds(self.xs[row], self.ys[row])
+
+    def alive(self, row):
+        return self.layer_ids[row] != DEAD
+
+    def rows(self, layer):
+        '''Live rows of layer in placement order'''
+        return compress(range(len(self.layer_ids)), map(LAYER_CODES[layer].__eq__, self.layer_ids))
+
+    def changed(self, row):
+        '''Note that row's area needs redrawing'''
+        t = self.types[self.type_ids[row]]
+        self.background.invalidate(self.bounds(row), t.layer != 'bg')
+        if self.damaged is not None:
+            self.damaged += [self.bounds(row)]
+
+    def index(self, row, notify=True):
+        if self.alive(row):
+            t = self.types[self.type_ids[row]]
+            x, y = self.key(row)
+            self.grids[t.layer].insert(row, x, y, t.width, t.height)
+            if notify:
+                self.changed(row)
+
+    def unindex(self, row):
+        t = self.types[self.type_ids[row]]
+        x, y = self.key(row)
+        self.grids[t.layer].remove(row, x, y)
+        self.changed(row)
+        
+    def draw_base(self):
+        pygame.draw.rect(self.game.display_surface, self.color, (self.camx, self.camy, self.size[0]*self.zoom, self.size[1]*self.zoom))
+
+    def add(self, type_id, x, y):
+        '''Place a sprite type at map coordinates, returns the new row'''
+        row = len(self.type_ids)
+        layer = self.types[type_id].layer
+        self.type_ids.append(type_id)
+        self.xs.append(int(x))
+        self.ys.append(int(y))
+        self.layer_ids.append(LAYER_CODES[layer])
+        self.counts[layer] += 1
+        self.index(row)
+        if self.journal:
+            self.journal.record(Journal.ADD, row)
+        if self.autosave:
+            self.autosave.added(row)
+        return row
+
+    def place(self, obj):
+        '''Place a New1/New2 at its mapx, mapy. Only its type and position are kept'''
+        return self.add(self.type_of(obj), obj.mapx, obj.mapy)
+    
+    def design(self, obj=[]):
+        return [self.place(i) for i in obj]
+
+    def decorate(self, obj=[]):
+        return [self.place(i) for i in obj]
+
+    def erase(self, row):
+        '''Remove a placed row from its layer and the index'''
+        if not self.alive(row):
+            return None
+        self.realize_row(row)
+        self.unindex(row)
+        self.counts[self.types[self.type_ids[row]].layer] -= 1
+        self.layer_ids[row] = DEAD
+        if self.journal:
+            self.journal.record(Journal.ERASE, row)
+        if self.autosave:
+            self.autosave.log(Autosave.ERASE, row)
+        return row
+
+    def erase_many(self, rows):
+        '''Remove every row in rows, skipping ones already gone'''
+        if self.journal:
+            self.journal.begin()
+        erased = [row for row in rows if self.erase(row) is not None]
+        if self.journal:
+            self.journal.end()
+        return erased
+
+    def erase_slices(self, rows, size=ERASE_SLICE):
+        '''erase_many size rows at a time, yields the share done after each slice.
+        The whole run is one undo step of its own, added once it is done'''
+        journal = self.journal
+        step = array('i')
+        try:
+            for start in range(0, len(rows), size):
+                saved = journal.enter(step) if journal else None
+                try:
+                    self.erase_many(rows[start:start+size])
+                finally:
+                    if journal:
+                        journal.leave(saved)
+                yield '{}%'.format(min(len(rows), start+size)*100//len(rows))
+        finally:
+            if journal:
+                journal.push(step)
+
+    def restore(self, row):
+        '''Bring an erased row back at its old position and place in the order'''
+        if self.alive(row):
+            return None
+        self.realize_row(row)
+        layer = self.types[self.type_ids[row]].layer
+        self.layer_ids[row] = LAYER_CODES[layer]
+        self.counts[layer] += 1
+        self.index(row)
+        if self.journal:
+            self.journal.record(Journal.ADD, row)
+        if self.autosave:
+            self.autosave.log(Autosave.RESTORE, row)
+        return row
+
+    def move(self, row, x, y):
+        '''Move a placed row to new map coordinates'''
+        self.realize_row(row)
+        if self.journal:
+            self.journal.record(Journal.MOVE, row, int(x)-self.xs[row], int(y)-self.ys[row])
+        self.unindex(row)
+        self.xs[row] = int(x)
+        self.ys[row] = int(y)
+        self.index(row)
+        if self.autosave:
+            self.autosave.log(Autosave.MOVE, row, self.xs[row], self.ys[row])
+
+    def snapshot(self):
+        '''Copy of the placement columns that another thread can read while this map
+        is edited. The copy has no spatial index, it is meant for export and save'''
+        m = Map(self.game, self.size)
+        m.name = self.name
+        m.color = self.color
+        m.types = list(self.types)
+        m.type_index = dict(self.type_index)
+        m.type_ids, m.xs, m.ys, m.layer_ids = self.type_ids[:], self.xs[:], self.ys[:], self.layer_ids[:]
+        m.counts = dict(self.counts)
+        m.tiles = self.tiles.copy(m)
+        return m
+
+    #Ground tiles, positions in map coordinates
+    def tile_type(self, obj):
+        return self.tiles.add_type(obj.name, obj.path)
+
+    def tiles_written(self, runs, tile):
+        '''Record and redraw runs of cells that were just set to tile'''
+        if not runs:
+            return runs
+        if self.journal:
+            self.journal.begin()
+            for start, length, old in runs:
+                self.journal.record(Journal.TILES, start, length, old << 8 | tile)
+            self.journal.end()
+        if self.autosave:
+            self.autosave.tiled(runs, tile)
+        area = self.tiles.area(*runs[0][:2]).unionall([self.tiles.area(start, length) for start, length, old in runs[1:]])
+        self.background.invalidate(area)
+        if self.damaged is not None:
+            self.damaged += [area]
+        return runs
+
+    def tile_run(self, start, length, tile):
+        return self.tiles_written(self.tiles.write(start, length, tile), tile)
+
+    def set_tile(self, x, y, tile):
+        '''Set the cell under the map point to tile (0 clears it)'''
+        self.tiles.fit()
+        cell = self.tiles.cell_of(x, y)
+        if cell is None:
+            return []
+        return self.tile_run(cell[1]*self.tiles.cols+cell[0], 1, tile)
+
+    def fill_tiles(self, rect, tile):
+        '''Set every cell overlapping the map rect to tile'''
+        self.tiles.fit()
+        rect = pygame.Rect(rect)
+        return self.tiles_written(self.tiles.fill(*self.tiles.clamp(rect.left, rect.top, rect.right, rect.bottom), tile), tile)
+
+    def flood_tiles(self, x, y, tile):
+        '''Set the area of equal cells around the map point to tile'''
+        self.tiles.fit()
+        cell = self.tiles.cell_of(x, y)
+        if cell is None:
+            return []
+        return self.tiles_written(self.tiles.flood(*cell, tile), tile)
+
+    #Lazy loading
+    def fit_grids(self):
+        '''Widen the grids' query margins to the largest sprite of each layer, so rows
+        that are loaded but not yet indexed are found'''
+        for t in self.types:
+            grid = self.grids[t.layer]
+            grid.padx = max(grid.padx, t.width/2)
+            grid.pady = max(grid.pady, t.height*1.5 if t.layer == 'objects' else t.height/2)
+        self.fitted = True
+
+    def realize(self, layer, left, top, right, bottom):
+        '''Index the loaded rows of layer that may overlap the rectangle'''
+        if not self.fitted:
+            self.fit_grids()
+        cells = self.pending[layer]
+        grid = self.grids[layer]
+        cx0, cy0 = int((left-grid.padx)//MAP_CELL), int((top-grid.pady)//MAP_CELL)
+        cx1, cy1 = int((right+grid.padx)//MAP_CELL), int((bottom+grid.pady)//MAP_CELL)
+        if (cx1-cx0+1)*(cy1-cy0+1) > len(cells):
+            keys = [(cx, cy) for cx, cy in cells if cx0 <= cx <= cx1 and cy0 <= cy <= cy1]
+        else:
+            keys = [(cx, cy) for cy in range(cy0, cy1+1) for cx in range(cx0, cx1+1) if (cx, cy) in cells]
+        for key in keys:
+            start, count = cells.pop(key)
+            for row in self.pending_order[start:start+count]:
+                self.index(row, False)
+
+    def realize_all(self):
+        '''Index every loaded row that is still pending'''
+        for cells in self.pending.values():
+            for start, count in cells.values():
+                for row in self.pending_order[start:start+count]:
+                    self.index(row, False)
+        self.pending = {}
+        self.pending_order = None
+
+    def realize_row(self, row):
+        '''Index the loaded cell holding row before erase, restore or move edit it, so a
+        row that is still pending neither misses the grid nor is indexed a second time later'''
+        if self.pending_order is None or row >= len(self.pending_order):
+            return #added since the load, never pending
+        layer = self.types[self.type_ids[row]].layer
+        if self.pending.get(layer):
+            x, y = self.xs[row], self.ys[row]
+            self.realize(layer, x, y, x, y)
+
+    def candidates(self, layer, left, top, right, bottom):
+        if self.pending.get(layer):
+            self.realize(layer, left, top, right, bottom)
+        return self.grids[layer].query(left, top, right, bottom)
+
+    #Camera: screen = map * zoom + cam
+    def zoom_to(self, level, x, y):
+        '''Zoom to 2**level, clamped to ZOOM_MIN..ZOOM_MAX, keeping the map point under the screen point (x, y) in place'''
+        level = max(ZOOM_MIN, min(ZOOM_MAX, level))
+        mapx, mapy = (x-self.camx)/self.zoom, (y-self.camy)/self.zoom
+        self.level = level
+        self.zoom = 2.0**level
+        self.camx = round(x - mapx*self.zoom)
+        self.camy = round(y - mapy*self.zoom)
+
+    def to_map(self, x, y):
+        '''Map point under the screen point'''
+        return math.floor((x-self.camx)/self.zoom), math.floor((y-self.camy)/self.zoom)
+
+    def screen_rect(self, rect):
+        '''Screen rect covering the map rect'''
+        left, top = math.floor(rect.left*self.zoom), math.floor(rect.top*self.zoom)
+        return pygame.Rect(left+self.camx, top+self.camy, math.ceil(rect.right*self.zoom)-left, math.ceil(rect.bottom*self.zoom)-top)
+
+    def view(self, area=None):
+        '''Camera rectangle, or the screen rect area, in map coordinates'''
+        if area is None:
+            area = self.game.display_surface.get_rect()
+        zoom = self.zoom
+        return (math.floor((area.left-self.camx)/zoom), math.floor((area.top-self.camy)/zoom), math.ceil((area.right-self.camx)/zoom), math.ceil((area.bottom-self.camy)/zoom))
+
+    def visible(self, layer, area=None):
+        left, top, right, bottom = self.view(area)
+        return self.query_rect(pygame.Rect(left, top, right-left, bottom-top), (layer,))
+
+    #Queries, all in map coordinates and returning rows
+    def query_point(self, x, y, layers=LAYERS):
+        '''Rows whose bounds contain the point'''
+        found = []
+        for layer in layers:
+            found += [row for row in self.candidates(layer, x, y, x, y) if self.bounds(row).collidepoint(x, y)]
+        return found
+
+    def query_rect(self, rect, layers=LAYERS):
+        '''Rows whose bounds overlap rect'''
+        rect = pygame.Rect(rect)
+        left, top, right, bottom = rect.left, rect.top, rect.right, rect.bottom
+        types, type_ids, xs, ys = self.types, self.type_ids, self.xs, self.ys
+        found = []
+        for layer in layers:
+            for row in self.candidates(layer, left, top, right, bottom):
+                t = types[type_ids[row]]
+                x = xs[row] - t.ox
+                y = ys[row] - t.oy
+                if x < right and x + t.width > left and y < bottom and y + t.height > top:
+                    found += [row]
+        return found
+
+    def query_radius(self, x, y, radius, layers=LAYERS):
+        '''Rows whose bounds come within radius of the point'''
+        found = []
+        for layer in layers:
+            for row in self.candidates(layer, x-radius, y-radius, x+radius, y+radius):
+                bounds = self.bounds(row)
+                dx = max(bounds.left-x, 0, x-bounds.right)
+                dy = max(bounds.top-y, 0, y-bounds.bottom)
+                if dx*dx + dy*dy <= radius*radius:
+                    found += [row]
+        return found
+
+    #Overlaps: bounds first, then the opaque pixels of the sprites' masks
+    def touching(self, row, other):
+        '''Whether the opaque pixels of two placements overlap'''
+        a, b = self.types[self.type_ids[row]], self.types[self.type_ids[other]]
+        offset = (self.xs[other]-b.ox - self.xs[row]+a.ox, self.ys[other]-b.oy - self.ys[row]+a.oy)
+        return MASKS.get(a.image).overlap(MASKS.get(b.image), offset) is not None
+
+    def overlapping(self, type_id, x, y, exact=True):
+        '''Rows of its layer that a placement of type_id at (x, y) would overlap'''
+        t = self.types[type_id]
+        rows = self.query_rect(t.bounds(x, y), (t.layer,))
+        if not exact:
+            return rows
+        mask = MASKS.get(t.image)
+        left, top = x-t.ox, y-t.oy
+        types, type_ids, xs, ys = self.types, self.type_ids, self.xs, self.ys
+        return [row for row in rows if mask.overlap(MASKS.get(types[type_ids[row]].image), (xs[row]-types[type_ids[row]].ox-left, ys[row]-types[type_ids[row]].oy-top)) is not None]
+
+    def overlap_pairs(self, layers=LAYERS, exact=True):
+        '''Yield (row, other), row < other, for each two live placements of one layer whose
+        bounds overlap and, with exact, whose opaque pixels do too. Rows are bucketed on a
+        grid of cells no smaller than the layer's largest sprite, so each is in at most four,
+        and a pair is only tested in the cell holding the top left of their intersection'''
+        types, type_ids, xs, ys = self.types, self.type_ids, self.xs, self.ys
+        for layer in layers:
+            rows = list(self.rows(layer))
+            if len(rows) < 2:
+                continue
+            cell = max([64] + [max(types[i].width, types[i].height) for i in set(type_ids[r] for r in rows)])
+            boxes = []
+            buckets = {}
+            for i, row in enumerate(rows):
+                t = types[type_ids[row]]
+                left, top = xs[row]-t.ox, ys[row]-t.oy
+                boxes.append((left, top, left+t.width, top+t.height))
+                for cx in range(left//cell, (left+t.width-1)//cell+1):
+                    for cy in range(top//cell, (top+t.height-1)//cell+1):
+                        bucket = buckets.get((cx, cy))
+                        if bucket is None:
+                            buckets[(cx, cy)] = [i]
+                        else:
+                            bucket.append(i)
+            for (cx, cy), bucket in buckets.items():
+                for n, i in enumerate(bucket):
+                    left, top, right, bottom = boxes[i]
+                    for j in bucket[n+1:]:
+                        left2, top2, right2, bottom2 = boxes[j]
+                        if left < right2 and left2 < right and top < bottom2 and top2 < bottom \
+                                and max(left, left2)//cell == cx and max(top, top2)//cell == cy \
+                                and (not exact or self.touching(rows[i], rows[j])):
+                            yield rows[i], rows[j]
+
+    def hit(self, layer, x, y):
+        '''Topmost row of layer under the screen point (x, y), or None'''
+        found = self.query_point(*self.to_map(x, y), (layer,))
+        if not found:
+            return None
+        return found[-1] if layer == 'objects' else max(found)
+
+    def draw(self, rows):
+        '''Blit rows in one batch, packed sprites straight from their atlas page'''
+        if self.level:
+            return self.draw_scaled(rows)
+        types, type_ids, xs, ys = self.types, self.type_ids, self.xs, self.ys
+        camx, camy = self.camx, self.camy
+        blits = []
+        for row in rows:
+            t = types[type_ids[row]]
+            surface, area = t.source
+            blits.append((surface, (xs[row]+camx-t.ox, ys[row]+camy-t.oy), area))
+        self.game.display_surface.blits(blits, False)
+
+    def draw_scaled(self, rows):
+        types, type_ids, xs, ys = self.types, self.type_ids, self.xs, self.ys
+        camx, camy, zoom, level = self.camx, self.camy, self.zoom, self.level
+        floor = math.floor
+        images = {}
+        blits = []
+        for row in rows:
+            t = types[type_ids[row]]
+            image = images.get(t)
+            if image is None:
+                image = images[t] = MIPS.get(t.image, level)
+            blits.append((image, (floor((xs[row]-t.ox)*zoom)+camx, floor((ys[row]-t.oy)*zoom)+camy)))
+        self.game.display_surface.blits(blits, False)
+            
+    def update(self, area=None):
+        '''Draw the map, only what falls inside the screen rect area if given'''
+        start = PROFILE.start()
+        self.background.draw(area)
+        start = PROFILE.stop('map bg', start)
+        if self.level <= POINT_LEVEL: #the chunks have every layer
+            return
+        for layer in ('objects', 'fg'):
+            rows = self.visible(layer, area)
+            self.draw(rows)
+            PROFILE.count('visible', len(rows))
+            PROFILE.count('blits', len(rows))
+            start = PROFILE.stop('map '+layer, start)
+        
+def unique(m, rows, seen=None):
+    '''Yield the rows that are the first placement at their position for their
+    sprite name. seen maps names to the positions already taken and is updated'''
+    seen = {} if seen is None else seen
+    names = [t.name for t in m.types]
+    type_ids, xs, ys = m.type_ids, m.xs, m.ys
+    for row in rows:
+        name = names[type_ids[row]]
+        taken = seen.get(name)
+        if taken is None:
+            taken = seen[name] = set()
+        pos = (xs[row], ys[row])
+        if pos not in taken:
+            taken.add(pos)
+            yield row
+
+def group(m, rows):
+    '''rows grouped by sprite name in first-seen order'''
+    groups = {}
+    names = [t.name for t in m.types]
+    type_ids = m.type_ids
+    for row in rows:
+        groups.setdefault(names[type_ids[row]], []).append(row)
+    return groups
+
+def tile_chunks(m, build, tally):
+    '''Yield the ground tiles as filled rectangles of cells, the runs of equal tiles
+    along each row merged with the same runs below. Written by both exports unless
+    compat is set'''
+    tiles = m.tiles
+    if not tiles.count:
+        return
+    yield m.name+':ground({}, {{\n'.format(tiles.size)
+    if build:
+        for tile, x, y, width, height in tiles.rects():
+            yield tiles.types[tile][0]+'.new():fill('+str(x)+', '+str(y)+', '+str(width)+', '+str(height)+'),\n'
+            tally['lines'] += 1
+    else:
+        groups = {}
+        for tile, x, y, width, height in tiles.rects():
+            groups.setdefault(tile, []).append('{'+str(x)+','+str(y)+','+str(width)+','+str(height)+'},')
+        for tile, rects in groups.items():
+            yield '{'+tiles.types[tile][0]+'.new,{' + ''.join(rects) + '}},\n'
+            tally['lines'] += 1
+    yield '})\n'
+
+def export_chunks(m, compat=False, tally=None):
+    '''Yield the Lua source written by export_map piece by piece. compat reproduces the
+    original output exactly: decorations are not deduplicated and the detail block is
+    only written when there are background decorations'''
+    tally = {} if tally is None else tally
+    tally.setdefault('lines', 0)
+    name = m.name
+    xs, ys, type_ids, types = m.xs, m.ys, m.type_ids, m.types
+    yield name + ' = map.new({}, {}, {})\n'.format(str(m.size[0]), str(m.size[1]), '{'+str(round(m.color[0]/255, 4))+', '+str(round(m.color[1]/255, 4))+', '+str(round(m.color[2]/255, 4))+'}')
+    if not compat:
+        yield from tile_chunks(m, False, tally)
+    if m.objects:
+        yield name+':spawn({\n'
+        for obj, rows in group(m, unique(m, m.rows('objects'))).items():
+            yield '{'+obj+'.new,{' + ''.join(['{'+str(xs[r])+','+str(ys[r])+'},' for r in rows]) + '}},\n'
+            tally['lines'] += 1
+        yield '})\n'
+
+    decorations = chain(m.rows('bg'), m.rows('fg'))
+    if compat:
+        groups = group(m, decorations)
+        if not m.images_bg:
+            tally['lines'] += len(groups)
+            return
+    else:
+        groups = group(m, unique(m, decorations))
+        if not groups:
+            return
+    yield name+':detail({\n'
+    for obj, rows in groups.items():
+        yield '{'+obj+'.new,{' + ''.join(['{'+str(xs[r])+','+str(ys[r])+(',1},' if types[type_ids[r]].z else '},') for r in rows]) + '}},\n'
+        tally['lines'] += 1
+    yield '})'
+
+def build_chunks(m, compat=False, tally=None):
+    '''Yield the Lua source written by build_map piece by piece. compat reproduces the
+    original output exactly: foreground decorations are left out and a decoration is
+    dropped when an object of the same name sits at its position'''
+    tally = {} if tally is None else tally
+    tally.setdefault('lines', 0)
+    name = m.name
+    xs, ys, type_ids, types = m.xs, m.ys, m.type_ids, m.types
+    yield name + ' = map.new()\n'
+    yield name + ':set({}, {}, {})'.format(str(m.size[0]), str(m.size[1]), '{'+str(m.color[0]/255)+', '+str(m.color[1]/255)+', '+str(m.color[2]/255)+'}') + '\n'
+    if not compat:
+        yield from tile_chunks(m, True, tally)
+    seen = {}
+    if m.objects:
+        yield name+':design({\n'
+        for r in unique(m, m.rows('objects'), seen):
+            yield types[type_ids[r]].name+'.new():at('+str(xs[r])+', '+str(ys[r])+'),\n'
+            tally['lines'] += 1
+        yield '})\n'
+
+    if compat:
+        if not m.images_bg:
+            return
+        rows = m.rows('bg')
+    else:
+        if not (m.images_bg or m.images_fg):
+            return
+        rows = chain(m.rows('bg'), m.rows('fg'))
+        seen = {}
+    yield name+':decorate({\n'
+    for r in unique(m, rows, seen):
+        t = types[type_ids[r]]
+        yield t.name+'.new():at('+str(xs[r])+', '+str(ys[r])+', '+str(t.z).lower()+'),\n'
+        tally['lines'] += 1
+    yield '})'
+
+def write_chunks(chunks, out, buffer=EXPORT_BUFFER, report=None):
+    '''Write chunks to out in joined blocks of about buffer characters, returns the number of characters written.
+    report is called with the running total after each block'''
+    parts = []
+    pending = 0
+    size = 0
+    for chunk in chunks:
+        parts.append(chunk)
+        pending += len(chunk)
+        if pending >= buffer:
+            out.write(''.join(parts))
+            size += pending
+            parts = []
+            pending = 0
+            if report:
+                report(size)
+    out.write(''.join(parts))
+    return size + pending
+
+def run_export(chunks, m, out, compat, stats, dump, progress=None, workers=1):
+    if m is None:
+        raise ValueError('no map to export')
+    if stats:
+        print('[INFO] Building Map.. ')
+    start = time.time()
+    tally = {'lines': 0}
+    target = io.StringIO() if out is None else out
+    report = (lambda size: progress('{} KB'.format(size >> 10))) if progress else None
+    if workers > 1 and len(m.type_ids) >= PARALLEL_EXPORT_MIN:
+        with export_pool(m, workers) as pool:
+            size = write_chunks(PARALLEL_CHUNKS[chunks](m, compat, tally, pool, name_tasks(m, workers)), target, report=report)
+    else:
+        size = write_chunks(chunks(m, compat, tally), target, report=report)
+    if stats:
+        print('[INFO] Map built successfully!')
+        print('[STATS] Name        : ', m.name)
+        print('[STATS] Lines       : ', tally['lines'])
+        print('[STATS] Size        : ', size)
+        print('[STATS] Build time  : ', round(time.time()-start, 4),'\n')
+    if out is not None:
+        return size
+    code = target.getvalue()
+    if dump:
+        print(code)
+    return code
+
+def export_map(out=None, m=None, compat=False, stats=True, dump=False, progress=None, workers=1):
+    '''Export the map m as Lua spawn/detail tables. Streams into the
+    file object out and returns the characters written, or returns the code when out is None.
+    With workers > 1 large maps are formatted in that many processes, the output is the same'''
+    return run_export(export_chunks, m, out, compat, stats, dump, progress, workers)
+
+def build_map(remove_clones=False, out=None, m=None, compat=False, stats=True, dump=False, progress=None, workers=1):
+    '''Export m as Lua design/decorate calls, see export_map'''
+    return run_export(build_chunks, m, out, compat, stats, dump, progress, workers)
+
+#Parallel export. Deduplication only compares placements of the same sprite name,
+#so the names are shared out between worker processes and their lines are put
+#back in the order a serial export writes them
+EXPORT = {}
+
+def export_init(names, zs, type_ids, xs, ys, layer_ids):
+    '''Worker process setup: keep the map columns for the tasks that follow'''
+    EXPORT.update(names=names, zs=zs, type_ids=type_ids, xs=xs, ys=ys, layer_ids=layer_ids)
+
+def export_pool(m, workers):
+    from concurrent.futures import ProcessPoolExecutor #multiprocessing is slow to import, only pay for it when used
+    return ProcessPoolExecutor(workers, initializer=export_init, initargs=([t.name for t in m.types], [t.z for t in m.types], m.type_ids, m.xs, m.ys, m.layer_ids))
+
+def name_tasks(m, parts):
+    '''The sprite type ids split into up to parts lists with about as many placements
+    each, types sharing a name always in the same list'''
+    counts = Counter(m.type_ids)
+    names = {}
+    for t in m.types:
+        names.setdefault(t.name, []).append(t.id)
+    bins = [(0, i, []) for i in range(parts)]
+    for ids in sorted(names.values(), key=lambda ids: -sum(counts[i] for i in ids)):
+        load, i, tids = bins[0]
+        tids += ids
+        bins[0] = (load + sum(counts[i] for i in ids), i, tids)
+        bins.sort()
+    return [tids for load, i, tids in bins if tids]
+
+def export_rows(tids, sections):
+    '''Worker: {(section, name): rows per layer code} for the sprite types in tids.
+    sections are tuples of layer codes'''
+    names, type_ids, layer_ids = EXPORT['names'], EXPORT['type_ids'], EXPORT['layer_ids']
+    where = {code: (s, i) for s, codes in enumerate(sections) for i, code in enumerate(codes)}
+    parts = {}
+    for row in compress(range(len(type_ids)), map(frozenset(tids).__contains__, type_ids)):
+        place = where.get(layer_ids[row])
+        if place is not None:
+            s, i = place
+            parts.setdefault((s, names[type_ids[row]]), [[] for _ in sections[s]])[i].append(row)
+    return parts
+
+def export_unique(rows, seen):
+    xs, ys = EXPORT['xs'], EXPORT['ys']
+    kept = []
+    for row in rows:
+        pos = (xs[row], ys[row])
+        if pos not in seen:
+            seen.add(pos)
+            kept.append(row)
+    return kept
+
+def export_groups(task):
+    '''Worker: (order, line) for each export_map group of the types in task'''
+    tids, sections, dedupe = task
+    xs, ys, zs, type_ids = EXPORT['xs'], EXPORT['ys'], EXPORT['zs'], EXPORT['type_ids']
+    lines = []
+    for (s, obj), per_code in export_rows(tids, sections).items():
+        first = min((i, rows[0]) for i, rows in enumerate(per_code) if rows)
+        rows = list(chain.from_iterable(per_code))
+        if dedupe[s]:
+            rows = export_unique(rows, set())
+        lines += [((s,) + first, '{'+obj+'.new,{' + ''.join(['{'+str(xs[r])+','+str(ys[r])+(',1},' if zs[type_ids[r]] else '},') for r in rows]) + '}},\n')]
+    return lines
+
+def build_keep(task):
+    '''Worker: {layer code: rows} that build_map writes for the types in task.
+    Layers in one section share their positions for deduplication'''
+    tids, sections = task
+    kept = {code: array('I') for codes in sections for code in codes}
+    for (s, obj), per_code in export_rows(tids, sections).items():
+        seen = set()
+        for code, rows in zip(sections[s], per_code):
+            kept[code].extend(export_unique(rows, seen))
+    return kept
+
+def build_lines(task):
+    '''Worker: the build_map lines for a slice of rows'''
+    rows, decorated = task
+    names, zs, type_ids, xs, ys = EXPORT['names'], EXPORT['zs'], EXPORT['type_ids'], EXPORT['xs'], EXPORT['ys']
+    if decorated:
+        return ''.join([names[type_ids[r]]+'.new():at('+str(xs[r])+', '+str(ys[r])+', '+('true' if zs[type_ids[r]] else 'false')+'),\n' for r in rows])
+    return ''.join([names[type_ids[r]]+'.new():at('+str(xs[r])+', '+str(ys[r])+'),\n' for r in rows])
+
+def build_parts(pool, rows, decorated, tally, parts):
+    size = max(4096, len(rows)//parts + 1)
+    tally['lines'] += len(rows)
+    yield from pool.map(build_lines, [(array('I', rows[i:i+size]), decorated) for i in range(0, len(rows), size)])
+
+def parallel_export_chunks(m, compat, tally, pool, tasks):
+    '''export_chunks with the groups formatted by the worker processes of pool'''
+    name = m.name
+    yield name + ' = map.new({}, {}, {})\n'.format(str(m.size[0]), str(m.size[1]), '{'+str(round(m.color[0]/255, 4))+', '+str(round(m.color[1]/255, 4))+', '+str(round(m.color[2]/255, 4))+'}')
+    if not compat:
+        yield from tile_chunks(m, False, tally)
+    sections = ((LAYER_CODES['objects'],), (LAYER_CODES['bg'], LAYER_CODES['fg']))
+    parts = sorted(chain.from_iterable(pool.map(export_groups, [(tids, sections, (True, not compat)) for tids in tasks])))
+    objects = [line for order, line in parts if order[0] == 0]
+    decorations = [line for order, line in parts if order[0] == 1]
+    if m.objects:
+        yield name+':spawn({\n'
+        yield from objects
+        tally['lines'] += len(objects)
+        yield '})\n'
+    if compat and not m.images_bg:
+        tally['lines'] += len(decorations)
+        return
+    if not decorations:
+        return
+    yield name+':detail({\n'
+    yield from decorations
+    tally['lines'] += len(decorations)
+    yield '})'
+
+def parallel_build_chunks(m, compat, tally, pool, tasks):
+    '''build_chunks with the deduplication and formatting done by the worker processes of pool'''
+    name = m.name
+    objects, bg, fg = LAYER_CODES['objects'], LAYER_CODES['bg'], LAYER_CODES['fg']
+    yield name + ' = map.new()\n'
+    yield name + ':set({}, {}, {})'.format(str(m.size[0]), str(m.size[1]), '{'+str(m.color[0]/255)+', '+str(m.color[1]/255)+', '+str(m.color[2]/255)+'}') + '\n'
+    if not compat:
+        yield from tile_chunks(m, True, tally)
+    sections = ((objects, bg),) if compat else ((objects,), (bg, fg))
+    kept = {code: [] for codes in sections for code in codes}
+    for part in pool.map(build_keep, [(tids, sections) for tids in tasks]):
+        for code, rows in part.items():
+            kept[code] += rows
+    if m.objects:
+        yield name+':design({\n'
+        yield from build_parts(pool, sorted(kept[objects]), False, tally, len(tasks))
+        yield '})\n'
+    if compat:
+        if not m.images_bg:
+            return
+        rows = sorted(kept[bg])
+    else:
+        if not (m.images_bg or m.images_fg):
+            return
+        rows = sorted(kept[bg]) + sorted(kept[fg])
+    yield name+':decorate({\n'
+    yield from build_parts(pool, rows, True, tally, len(tasks))
+    yield '})'
+
+PARALLEL_CHUNKS = {export_chunks: parallel_export_chunks, build_chunks: parallel_build_chunks}
+
+#========================================
+#   MAP FILES
+#   little endian: header, sprite type table, placement columns in placement
+#   order, a directory of grid cells pointing into a spatially sorted
+#   permutation of the placements, the layer column, then the tile table
+#   and the ground tile cells
+#========================================
+
+MAP_MAGIC = b'UNTM'
+MAP_VERSION = 3
+MAP_CELL = 256
+MAP_HEADER = struct.Struct('<4sHiiBBBIII')
+MAP_CELL_ENTRY = struct.Struct('<BiiII')
+MAP_TILES = struct.Struct('<BII')
+MAP_LAYERS = ('bg', 'objects', 'fg')
+
+def pack_str(text):
+    data = text.encode('utf-8')
+    return struct.pack('<H', len(data)) + data
+
+def save_map(m, path, dead=False, verbose=True):
+    '''Write the live placements of m in the binary map format. With dead erased rows
+    are written too, after the live ones in the spatial order, so that rows keep
+    their numbers when the file is loaded'''
+    if dead:
+        live = array('I', range(len(m.layer_ids)))
+    else:
+        live = array('I', compress(range(len(m.layer_ids)), map(DEAD.__ne__, m.layer_ids)))
+    type_ids = array('I', [m.type_ids[r] for r in live])
+    xs = array('i', [m.xs[r] for r in live])
+    ys = array('i', [m.ys[r] for r in live])
+    layer_ids = array('B', [m.layer_ids[r] for r in live])
+    cells = {}
+    for n in range(len(live)):
+        if layer_ids[n] != DEAD:
+            cells.setdefault((layer_ids[n], xs[n]//MAP_CELL, ys[n]//MAP_CELL), array('I')).append(n)
+    order = array('I')
+    directory = []
+    for key in sorted(cells):
+        directory += [MAP_CELL_ENTRY.pack(key[0], key[1], key[2], len(order), len(cells[key]))]
+        order += cells[key]
+    order += array('I', [n for n in range(len(live)) if layer_ids[n] == DEAD])
+    if sys.byteorder != 'little':
+        for column in (type_ids, xs, ys, order):
+            column.byteswap()
+    with open(path, 'wb') as f:
+        f.write(MAP_HEADER.pack(MAP_MAGIC, MAP_VERSION, m.size[0], m.size[1], *m.color, len(m.types), len(live), len(directory)))
+        f.write(pack_str(m.name))
+        for t in m.types:
+            f.write(struct.pack('<B', LAYER_CODES[t.layer]) + pack_str(t.name) + pack_str(t.path))
+        for column in (type_ids, xs, ys, order):
+            column.tofile(f)
+        f.write(b''.join(directory))
+        layer_ids.tofile(f)
+        tiles = m.tiles
+        f.write(MAP_TILES.pack(len(tiles.types)-1, tiles.cols, tiles.rows))
+        for name, loc in tiles.types[1:]:
+            f.write(pack_str(name) + pack_str(loc))
+        f.write(tiles.cells)
+        f.flush()
+        os.fsync(f.fileno())
+    if verbose:
+        print('[INFO] Saved', len(live), 'placements to', path)
+
+class MapFile:
+    '''Memory-mapped reader for the binary map format'''
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(data)
+        try:
+            self.read(path, view)
+        finally:
+            view.release()
+            data.close()
+
+    def read(self, path, view):
+        magic, version, width, height, r, g, b, ntypes, count, ncells = MAP_HEADER.unpack_from(view)
+        if magic != MAP_MAGIC or version not in (1, 2, MAP_VERSION):
+            raise ValueError('{} is not a map file this editor can read'.format(path))
+        self.size = (width, height)
+        self.color = (r, g, b)
+        self.count = count
+        offset = MAP_HEADER.size
+        self.name, offset = self.read_str(view, offset)
+        self.types = []
+        for _ in range(ntypes):
+            layer = view[offset]
+            sprite, offset = self.read_str(view, offset+1)
+            loc, offset = self.read_str(view, offset)
+            self.types += [(MAP_LAYERS[layer], sprite, loc)]
+        self.type_ids, offset = self.column(view, offset, 'I', count)
+        self.xs, offset = self.column(view, offset, 'i', count)
+        self.ys, offset = self.column(view, offset, 'i', count)
+        self.order, offset = self.column(view, offset, 'I', count)
+        self.cells = {layer: {} for layer in MAP_LAYERS}
+        end = offset + ncells*MAP_CELL_ENTRY.size
+        for layer, cx, cy, start, length in MAP_CELL_ENTRY.iter_unpack(view[offset:end]):
+            self.cells[MAP_LAYERS[layer]][(cx, cy)] = (start, length)
+        if version == 1:
+            layers = [LAYER_CODES[t[0]] for t in self.types]
+            self.layer_ids = array('B', [layers[t] for t in self.type_ids])
+        else:
+            self.layer_ids = array('B')
+            self.layer_ids.frombytes(view[end:end+count])
+        self.tile_types = []
+        self.tile_size = (0, 0)
+        self.tiles = bytearray()
+        if version >= 3:
+            offset = end+count
+            ntiles, cols, rows = MAP_TILES.unpack_from(view, offset)
+            offset += MAP_TILES.size
+            for _ in range(ntiles):
+                sprite, offset = self.read_str(view, offset)
+                loc, offset = self.read_str(view, offset)
+                self.tile_types += [(sprite, loc)]
+            self.tile_size = (cols, rows)
+            self.tiles = bytearray(view[offset:offset+cols*rows])
+
+    @staticmethod
+    def read_str(view, offset):
+        length = struct.unpack_from('<H', view, offset)[0]
+        offset += 2
+        return bytes(view[offset:offset+length]).decode('utf-8'), offset+length
+
+    @staticmethod
+    def column(view, offset, code, count):
+        end = offset + count*4
+        column = array(code)
+        column.frombytes(view[offset:end])
+        if sys.byteorder != 'little':
+            column.byteswap()
+        return column, end
+
+def load_map(path, game=None):
+    '''Open a saved map. The columns are read in one go, the spatial index is
+    built cell by cell as the camera or a query reaches it'''
+    source = MapFile(path)
+    m = Map(game, source.size)
+    m.name = source.name
+    m.color = source.color
+    ids = [m.add_type(layer, sprite, loc) for layer, sprite, loc in source.types]
+    if ids != list(range(len(ids))):
+        source.type_ids = array('I', [ids[t] for t in source.type_ids])
+    m.type_ids, m.xs, m.ys, m.layer_ids = source.type_ids, source.xs, source.ys, source.layer_ids
+    m.fitted = False
+    for layer, code in LAYER_CODES.items():
+        m.counts[layer] = m.layer_ids.count(code)
+    m.pending = source.cells
+    m.pending_order = source.order
+    tiles = m.tiles
+    for sprite, loc in source.tile_types:
+        tiles.add_type(sprite, loc)
+    (tiles.cols, tiles.rows), tiles.cells = source.tile_size, source.tiles
+    tiles.count = len(tiles.cells) - tiles.cells.count(0)
+    print('[INFO] Loaded', path, '(', source.count, 'placements )')
+    return m
+
+#========================================
+#   AUTOSAVE
+#   generation g is a snapshot in the map format, autosave-g.umap, and the
+#   edits made after it, autosave-g.log: a header, then fixed-size records
+#   (op, row, a, b, c). Type records are followed by b bytes of names
+#========================================
+
+AUTOSAVE_MAGIC = b'UNTJ'
+AUTOSAVE_VERSION = 1
+AUTOSAVE_HEADER = struct.Struct('<4sHI')
+AUTOSAVE_RECORD = struct.Struct('<BIiii')
+
+def autosave_path(folder, generation, ext):
+    return os.path.join(folder, 'autosave-{}{}'.format(generation, ext))
+
+def autosave_generations(folder, exts=('.umap',)):
+    '''Generations with a file of one of exts in folder, ascending'''
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return []
+    found = set()
+    for name in names:
+        for ext in exts: #whole suffixes, '.umap.tmp' has two dots
+            base = name[9:-len(ext)]
+            if name.startswith('autosave-') and name.endswith(ext) and base.isdigit():
+                found.add(int(base))
+    return sorted(found)
+
+class Autosave:
+    '''Keeps a crash-safe copy of a map on disk while it is edited. The Map hooks
+    append records to an in-memory buffer, tick() hands the buffer to a writer thread
+    every interval seconds and once compact bytes have been logged the map is copied
+    and written as the next generation's snapshot. The UI thread only ever packs
+    records and copies columns, the writer does all file work'''
+    ADD, ERASE, RESTORE, MOVE, TILES, TYPE, TILE_TYPE = range(7)
+    FILES = ('.umap', '.log', '.umap.tmp') #a snapshot cut short by a crash stays a .umap.tmp until the next one
+
+    def __init__(self, m, folder, interval=AUTOSAVE_INTERVAL, compact=AUTOSAVE_COMPACT):
+        import queue
+        os.makedirs(folder, exist_ok=True)
+        self.map = m
+        self.folder = folder
+        self.interval = interval
+        self.compact = compact
+        self.buffer = bytearray()
+        self.logged = 0
+        self.flushed = time.perf_counter()
+        self.generation = max(autosave_generations(folder, self.FILES), default=0)
+        self.types = 0
+        self.tile_types = 0
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.write, name='autosave', daemon=True)
+        self.thread.start()
+        m.autosave = self
+        self.snapshot()
+
+    def log(self, op, row, a=0, b=0, c=0):
+        self.buffer += AUTOSAVE_RECORD.pack(op, row, a, b, c)
+
+    def named(self, op, id, layer, name, path):
+        data = pack_str(name) + pack_str(path)
+        self.buffer += AUTOSAVE_RECORD.pack(op, id, layer, len(data), 0) + data
+
+    def added(self, row):
+        m = self.map
+        while self.types < len(m.types):
+            t = m.types[self.types]
+            self.named(self.TYPE, self.types, LAYER_CODES[t.layer], t.name, t.path)
+            self.types += 1
+        self.log(self.ADD, row, m.type_ids[row], m.xs[row], m.ys[row])
+
+    def tiled(self, runs, tile):
+        tiles = self.map.tiles
+        while self.tile_types < len(tiles.types)-1:
+            self.tile_types += 1
+            self.named(self.TILE_TYPE, self.tile_types, 0, *tiles.types[self.tile_types])
+        for start, length, old in runs:
+            self.log(self.TILES, start, length, tile)
+
+    def tick(self):
+        '''Call once a frame: passes on the records of the last interval and
+        snapshots once the log is big enough'''
+        if self.buffer and time.perf_counter()-self.flushed >= self.interval:
+            self.flush()
+        if self.logged >= self.compact:
+            self.snapshot()
+
+    def flush(self):
+        if self.buffer:
+            self.logged += len(self.buffer)
+            self.queue.put(('log', self.generation, bytes(self.buffer)))
+            self.buffer.clear()
+        self.flushed = time.perf_counter()
+
+    def snapshot(self):
+        '''Start the next generation from a copy of the map'''
+        self.flush()
+        self.generation += 1
+        self.logged = 0
+        self.types, self.tile_types = len(self.map.types), len(self.map.tiles.types)-1
+        self.queue.put(('snapshot', self.generation, self.map.snapshot()))
+
+    def close(self):
+        '''Write what is left and stop the writer, the files stay for recover()'''
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.map.autosave = None
+
+    def write(self):
+        '''Writer thread: append log batches, fsynced, and write snapshots. A snapshot
+        is renamed into place once complete, then older generations are removed'''
+        log = None
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            kind, generation, data = task
+            try:
+                if kind == 'snapshot':
+                    if log:
+                        log.close()
+                        log = None
+                    path = autosave_path(self.folder, generation, '.umap')
+                    save_map(data, path+'.tmp', True, False)
+                    os.replace(path+'.tmp', path)
+                    for old in autosave_generations(self.folder, self.FILES):
+                        if old < generation:
+                            for ext in self.FILES:
+                                if os.path.exists(autosave_path(self.folder, old, ext)):
+                                    os.remove(autosave_path(self.folder, old, ext))
+                    continue
+                path = autosave_path(self.folder, generation, '.log')
+                if log is None or log.name != path:
+                    if log:
+                        log.close()
+                    log = open(path, 'ab')
+                    if not log.tell():
+                        log.write(AUTOSAVE_HEADER.pack(AUTOSAVE_MAGIC, AUTOSAVE_VERSION, generation))
+                log.write(data)
+                log.flush()
+                os.fsync(log.fileno())
+            except Exception as e:
+                print('[ERROR] Autosave failed:', repr(e))
+        if log:
+            log.close()
+
+def replay(m, path):
+    '''Apply the edits logged at path to m, loaded from the snapshot they follow.
+    A record cut short by a crash ends the replay. Returns the number applied'''
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return 0
+    if len(data) < AUTOSAVE_HEADER.size or AUTOSAVE_HEADER.unpack_from(data)[:2] != (AUTOSAVE_MAGIC, AUTOSAVE_VERSION):
+        return 0
+    offset = AUTOSAVE_HEADER.size
+    record, size, end = AUTOSAVE_RECORD, AUTOSAVE_RECORD.size, len(data)
+    count = 0
+    while offset+size <= end:
+        op, row, a, b, c = record.unpack_from(data, offset)
+        offset += size
+        if op in (Autosave.TYPE, Autosave.TILE_TYPE):
+            if offset+b > end:
+                break
+            name, loc = MapFile.read_str(data, offset)
+            loc, _ = MapFile.read_str(data, loc)
+            offset += b
+            if op == Autosave.TYPE:
+                m.add_type(MAP_LAYERS[a], name, loc)
+            else:
+                m.tiles.add_type(name, loc)
+        elif op == Autosave.ADD:
+            if m.add(a, b, c) != row:
+                raise ValueError('{} does not follow its snapshot'.format(path))
+        elif op == Autosave.ERASE:
+            m.erase(row)
+        elif op == Autosave.RESTORE:
+            m.restore(row)
+        elif op == Autosave.MOVE:
+            m.move(row, a, b)
+        elif op == Autosave.TILES:
+            m.tiles.fit()
+            m.tile_run(row, a, b)
+        count += 1
+    return count
+
+def recover(folder, game=None):
+    '''The map autosaved in folder: its newest snapshot with the edits logged after
+    it replayed. None if there is no autosave'''
+    generations = autosave_generations(folder)
+    if not generations:
+        return None
+    start = time.perf_counter()
+    m = load_map(autosave_path(folder, generations[-1], '.umap'), game)
+    count = replay(m, autosave_path(folder, generations[-1], '.log'))
+    print('[INFO] Recovered', m.name, 'from', folder, 'replaying', count, 'edits in', round((time.perf_counter()-start)*1000), 'ms')
+    return m
+
+#========================================
+#   COMMAND LINE
+#   python -m mapcore export|build|validate|stats|overlaps MAPS
+#========================================
+
+def map_paths(args):
+    '''The .umap files named in args, directories standing for the maps in them'''
+    paths = []
+    for path in args:
+        if os.path.isdir(path):
+            paths += sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.umap'))
+        else:
+            paths += [path]
+    return paths
+
+def export_file(job, workers=1):
+    '''Export one saved map to a Lua file, returns the Lua path or None if it failed'''
+    path, out, build, compat = job
+    try:
+        m = load_map(path)
+        with open(out, 'w', newline='') as f:
+            (build_map if build else export_map)(out=f, m=m, compat=compat, stats=False, workers=workers)
+    except Exception as e:
+        print('[ERROR] Could not export', path, repr(e))
+        return None
+    print('[INFO] Saved', out)
+    return out
+
+def batch(paths, out=None, build=False, compat=False, workers=EXPORT_WORKERS):
+    '''Export saved maps to Lua, several maps at once when workers > 1. Returns the exit status'''
+    if out:
+        os.makedirs(out, exist_ok=True)
+    jobs = [(path, os.path.join(out or os.path.dirname(path), os.path.splitext(os.path.basename(path))[0]+'.lua'), build, compat) for path in paths]
+    start = time.time()
+    if workers > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(min(workers, len(jobs))) as pool:
+            done = list(pool.map(export_file, jobs))
+    else:
+        done = [export_file(job, workers) for job in jobs]
+    print('[STATS] Exported', len(done)-done.count(None), 'of', len(jobs), 'maps in', round(time.time()-start, 2), 's')
+    return 1 if None in done else 0
+
+def validate(m):
+    '''Problems with a map as (errors, warnings): sprite files that are missing or
+    unreadable, placements outside the map and duplicate placements'''
+    errors = []
+    warnings = []
+    for t in m.types:
+        if not os.path.isfile(t.path):
+            errors += ['sprite {} ({}): missing file {}'.format(t.name, t.layer, t.path)]
+            continue
+        try:
+            ASSETS.load(t.path)
+        except ImportError:
+            pass #without pygame only the file's presence is checked
+        except Exception as e:
+            errors += ['sprite {} ({}): cannot read {}: {}'.format(t.name, t.layer, t.path, e)]
+    for name, path in m.tiles.types[1:]:
+        if not os.path.isfile(path):
+            errors += ['tile {}: missing file {}'.format(name, path)]
+    live = [row for row in range(len(m.layer_ids)) if m.layer_ids[row] != DEAD]
+    outside = sum(1 for row in live if not (0 <= m.xs[row] <= m.size[0] and 0 <= m.ys[row] <= m.size[1]))
+    if outside:
+        warnings += ['{} placements outside the {}x{} map'.format(outside, m.size[0], m.size[1])]
+    kept = sum(1 for layer in ('objects', 'bg', 'fg') for row in unique(m, m.rows(layer)))
+    if kept < len(live):
+        warnings += ['{} duplicate placements (same sprite and position), left out of exports'.format(len(live)-kept)]
+    if not errors:
+        try:
+            pairs = sum(1 for pair in m.overlap_pairs(('objects',)))
+        except ImportError:
+            pairs = 0 #masks need pygame
+        if pairs:
+            warnings += ['{} pairs of overlapping objects, see the overlaps command'.format(pairs)]
+    return errors, warnings
+
+def stats(m):
+    live = [row for row in range(len(m.layer_ids)) if m.layer_ids[row] != DEAD]
+    print('[STATS] Name        : ', m.name)
+    print('[STATS] Size        : ', m.size[0], 'x', m.size[1])
+    print('[STATS] Placements  : ', len(live), '(' + ', '.join('{} {}'.format(layer, m.counts[layer]) for layer in ('objects', 'bg', 'fg')) + ')')
+    print('[STATS] Sprite types: ', len(m.types), '(' + str(len({t.name for t in m.types})), 'names)')
+    if m.tiles.count:
+        print('[STATS] Tiles       : ', m.tiles.count, 'cells of', m.tiles.size, 'px (' + str(len(m.tiles.types)-1), 'kinds)')
+    if live:
+        xs = [m.xs[row] for row in live]
+        ys = [m.ys[row] for row in live]
+        print('[STATS] Extent      : ', (min(xs), min(ys)), 'to', (max(xs), max(ys)))
+
+def overlaps(m, layers=Map.LAYERS, exact=True):
+    '''Print every pair of overlapping placements, returns how many there were'''
+    names = [t.name for t in m.types]
+    count = 0
+    for row, other in m.overlap_pairs(layers, exact):
+        print('[OVERLAP]', names[m.type_ids[row]], (m.xs[row], m.ys[row]), names[m.type_ids[other]], (m.xs[other], m.ys[other]))
+        count += 1
+    print('[STATS]', m.name+':', count, 'overlapping pairs')
+    return count
+
+def cli(argv=None):
+    '''Build, export, validate or summarise saved maps without the editor. Returns the exit status'''
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m mapcore', description='Work with saved maps without opening the editor.')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+    for name, help in (('export', 'write Lua spawn/detail tables (Export Map)'), ('build', 'write Lua design/decorate calls (Build Map)')):
+        command = commands.add_parser(name, help=help)
+        command.add_argument('maps', nargs='+', help='.umap files, or directories of them')
+        command.add_argument('-o', '--out', help='directory for the .lua files (default: next to each map)')
+        command.add_argument('--compat', action='store_true', help='reproduce the output of older versions exactly')
+        command.add_argument('-j', '--workers', type=int, default=EXPORT_WORKERS, help='processes to use (default: %(default)s)')
+    for name, help in (('validate', 'check for missing sprites, stray, duplicate and overlapping placements'), ('stats', 'print placement counts and extents')):
+        command = commands.add_parser(name, help=help)
+        command.add_argument('maps', nargs='+', help='.umap files, or directories of them')
+    command = commands.add_parser('overlaps', help='list the pairs of placements of one layer that overlap')
+    command.add_argument('maps', nargs='+', help='.umap files, or directories of them')
+    command.add_argument('--layers', nargs='+', choices=Map.LAYERS, default=['objects'], help='layers to check (default: objects)')
+    command.add_argument('--bounds', action='store_true', help='compare bounding rects only, not pixels')
+    args = parser.parse_args(argv)
+    paths = map_paths(args.maps)
+    if args.command in ('export', 'build'):
+        return batch(paths, args.out, args.command == 'build', args.compat, args.workers)
+    status = 0
+    for path in paths:
+        try:
+            m = load_map(path)
+        except Exception as e:
+            print('[ERROR] Could not open', path, repr(e))
+            status = 1
+            continue
+        if args.command == 'stats':
+            stats(m)
+            continue
+        if args.command == 'overlaps':
+            overlaps(m, args.layers, not args.bounds)
+            continue
+        errors, warnings = validate(m)
+        for problem in errors:
+            print('[ERROR]', path+':', problem)
+        for problem in warnings:
+            print('[WARNING]', path+':', problem)
+        if errors:
+            status = 1
+        elif not warnings:
+            print('[INFO]', path, 'is valid')
+    return status
+
+if __name__ == '__main__':
+    sys.exit(cli())